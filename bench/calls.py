@@ -0,0 +1,55 @@
+"""
+Count how many times each crawled page is parsed and hashed.
+
+Link extraction and the checksum hash are wrapped with counters, so calls
+are seen from every thread, including the database writer's.
+
+    python bench/calls.py [--urls N] [--links N] [--extractor NAME]
+        [--stream-parse]
+"""
+import collections
+import logging
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import serving, temporary_database, make_crawler, make_pages
+from unfurl import page
+
+CALLS = collections.Counter()
+
+def counted(label, func):
+    def wrapper(*args, **kwargs):
+        CALLS[label] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+def instrument():
+    page.extract_links = counted('link extractions', page.extract_links)
+    page.digest_links = counted('checksums', page.digest_links)
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--urls', type=int, default=500)
+    cli.add_option('--links', type=int, default=100)
+    cli.add_option('--extractor', default='soup')
+    cli.add_option('--stream-parse', action='store_true', default=False)
+    opts, args = cli.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    instrument()
+    with serving() as server, temporary_database() as path:
+        crawler = make_crawler(path, count=1, period=3600,
+            extractor=opts.extractor, stream_parse=opts.stream_parse)
+        crawler.crawl(make_pages('%s/%d?%%d' % (server.url, opts.links),
+            opts.urls))
+
+    print 'urls:              %d (%d links each)' % (opts.urls, opts.links)
+    for label in ('link extractions', 'checksums'):
+        print '%-18s %.2f calls/page' % (label + ':',
+            CALLS[label] / float(opts.urls))
+
+if __name__ == '__main__':
+    main()
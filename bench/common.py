@@ -0,0 +1,59 @@
+"""
+Setup shared by the crawl benchmarks: a local site to crawl, a throwaway
+database, a quiet crawler and peak memory readings.
+"""
+import contextlib
+import logging
+import os
+import resource
+import shutil
+import tempfile
+
+from server import PageServer
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextlib.contextmanager
+def serving(**options):
+    """
+    Serve a ``server.PageServer`` built with ``options`` for the duration
+    of the ``with`` block
+    """
+    server = PageServer(**options).start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+
+@contextlib.contextmanager
+def temporary_database():
+    """
+    The path of a database file that's deleted after the ``with`` block
+    """
+    tmpdir = tempfile.mkdtemp(prefix='unfurl-bench-')
+    try:
+        yield os.path.join(tmpdir, 'unfurl.db')
+    finally:
+        shutil.rmtree(tmpdir)
+
+def make_crawler(path, crawler_class=None, **options):
+    """
+    A ``Crawler`` (or ``crawler_class``) built with ``options``, storing
+    its snapshots in a new database at ``path`` and logging only warnings
+    """
+    # imported here so the crawl benchmark's parent process stays light,
+    # and each mode's process imports its own engine
+    from unfurl.crawler import Crawler
+    from unfurl.db import Database
+
+    options.setdefault('log_level', logging.WARNING)
+    return (crawler_class or Crawler)(db=Database(path), **options)
+
+def make_pages(url_format, count):
+    """
+    ``count`` pages, page ``i`` at ``url_format % i``
+    """
+    from unfurl.page import Page
+    return [ Page(url_format % i) for i in xrange(count) ]
@@ -0,0 +1,226 @@
+"""
+Crawl a local synthetic site end to end in each crawl mode and report
+pages/sec, per-page latency, peak RSS and database growth.
+
+Every mode runs in a fresh process (so peak RSS and gevent's monkey-patching
+don't leak between modes) against a fresh copy of the site served by
+``server.PageServer``: ``--pages`` pages of ``--links`` links, padded to
+``--size`` bytes, each answering after ``--latency`` seconds and changing
+with probability ``--change-rate`` per fetch. Each page is crawled
+``--rounds`` times, every ``--period`` seconds: back to back by default,
+while a longer period has the scheduler idle between crawls as it does in
+production. Results can be saved as JSON and compared with an earlier run,
+e.g. from another commit:
+
+    python bench/crawl.py [--pages N] [--links N] [--size BYTES]
+        [--change-rate P] [--latency SECONDS] [--rounds N] [--period SECONDS]
+        [--threads N] [--modes unthreaded,threaded,async] [--extractor NAME]
+        [--seed N] [--output FILE] [--compare FILE]
+"""
+import logging
+import optparse
+import os
+import subprocess
+import sys
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import peak_rss, serving, temporary_database, make_crawler, \
+    make_pages
+
+# mode -> Crawler arguments; add new engines here
+MODES = {
+  'unthreaded': {'threaded': False},
+  'threaded': {'threaded': True},
+  'async': {'engine': 'async'},
+}
+DEFAULT_MODES = 'unthreaded,threaded,async'
+
+# result -> whether bigger is better, for --compare
+METRICS = [
+  ('pages_per_second', True),
+  ('latency_p50_ms', False),
+  ('latency_p99_ms', False),
+  ('peak_rss_mib', False),
+  ('db_growth_mib', False),
+  ('snapshots', None),
+]
+
+def percentile(values, fraction):
+    """
+    The nearest-rank ``fraction`` percentile of the sorted list ``values``
+    """
+    if not values:
+        return 0.0
+    index = int(round(fraction * len(values) + 0.5)) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def database_size(path):
+    # the write-ahead log holds whatever hasn't been checkpointed yet
+    return sum(os.path.getsize(i) for i in (path, path + '-wal') \
+        if os.path.exists(i))
+
+def run_mode(mode, url, opts):
+    """
+    Crawl the site at ``url`` in ``mode`` and return its results
+    """
+    if MODES[mode].get('engine') == 'async':
+        # before the crawler imports requests
+        from unfurl.util import patch_for_gevent
+        patch_for_gevent()
+
+    from unfurl.crawler import Crawler
+    from unfurl.db import Snapshot
+
+    class TimedCrawler(Crawler):
+        def crawl_page(self, page):
+            start = time.time()
+            try:
+                Crawler.crawl_page(self, page)
+            finally:
+                latencies.append(time.time() - start)
+
+    latencies = []
+    with temporary_database() as path:
+        crawler = make_crawler(path, TimedCrawler, count=opts.rounds,
+            period=opts.period, max_threads=opts.threads,
+            concurrency=opts.threads, extractor=opts.extractor,
+            **MODES[mode])
+        pages = make_pages(url + '/page/%d', opts.pages)
+        db_before, rss_before = database_size(path), peak_rss()
+
+        start = time.time()
+        crawler.crawl(pages)
+        elapsed = time.time() - start
+
+        rss_after, db_after = peak_rss(), database_size(path)
+        snapshots = Snapshot.select().count()
+
+    latencies.sort()
+    return {
+      'fetches': len(latencies),
+      'seconds': elapsed,
+      'pages_per_second': len(latencies) / elapsed,
+      'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+      'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+      'peak_rss_mib': rss_after / 1024.0,
+      'crawl_rss_mib': (rss_after - rss_before) / 1024.0,
+      'db_growth_mib': (db_after - db_before) / 1024.0 / 1024,
+      'snapshots': snapshots,
+      'counters': crawler.round_stats,
+    }
+
+def spawn(mode, opts):
+    """
+    Serve a fresh copy of the site and crawl it in ``mode`` in a new
+    process, returning its results
+    """
+    with serving(links=opts.links, size=opts.size,
+      change_rate=opts.change_rate, latency=opts.latency,
+      seed=opts.seed) as server:
+        output = subprocess.check_output([sys.executable, __file__] + \
+            sys.argv[1:] + ['--run-mode', mode, '--url', server.url])
+    return json.loads(output)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+            'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def show(results, baseline=None):
+    print '%-12s %9s %9s %9s %9s %9s %9s' % ('mode', 'pages/s', 'p50 ms',
+        'p99 ms', 'rss MiB', 'db MiB', 'snapshots')
+    for mode, result in results:
+        print '%-12s %9.1f %9.2f %9.2f %9.1f %9.2f %9d' % (mode,
+            result['pages_per_second'], result['latency_p50_ms'],
+            result['latency_p99_ms'], result['peak_rss_mib'],
+            result['db_growth_mib'], result['snapshots'])
+
+        old = (baseline or {}).get(mode)
+        if old is None:
+            continue
+        changes = []
+        for name, higher_better in METRICS:
+            if higher_better is None or not old.get(name):
+                continue
+            changes.append('%+8.1f%%' % \
+                ((result[name] - old[name]) * 100.0 / old[name]))
+        print '%-12s %s' % ('  vs base', ' '.join(changes))
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--pages', type=int, default=200)
+    cli.add_option('--links', type=int, default=100)
+    cli.add_option('--size', type=int, default=0,
+      help='pad each page out to this many bytes')
+    cli.add_option('--change-rate', type=float, default=0.1,
+      help='chance a page changes each time it is fetched')
+    cli.add_option('--latency', type=float, default=0.005,
+      help='server response delay (seconds)')
+    cli.add_option('--rounds', type=int, default=5,
+      help='times each page is crawled')
+    cli.add_option('--period', type=float, default=0,
+      help='seconds between crawls of a page (defaults to 0, back to back)')
+    cli.add_option('--threads', type=int, default=10,
+      help='worker threads, or greenlets for the async mode')
+    cli.add_option('--modes', default=DEFAULT_MODES,
+      help='comma-separated crawl modes (from: %s)' % \
+        ', '.join(sorted(MODES)))
+    cli.add_option('--extractor', help='link extractor (default: the '
+      'configured one)')
+    cli.add_option('--seed', type=int, default=0,
+      help='seed for which fetches change a page')
+    cli.add_option('-o', '--output', help='save the results to this file')
+    cli.add_option('--compare', metavar='FILE',
+      help='show the change from results saved with --output')
+    cli.add_option('--run-mode', help=optparse.SUPPRESS_HELP)
+    cli.add_option('--url', help=optparse.SUPPRESS_HELP)
+    opts, args = cli.parse_args()
+
+    if opts.run_mode:
+        logging.basicConfig(level=logging.WARNING)
+        print json.dumps(run_mode(opts.run_mode, opts.url, opts))
+        return
+
+    modes = [ i.strip() for i in opts.modes.split(',') if i.strip() ]
+    unknown = [ i for i in modes if i not in MODES ]
+    if unknown:
+        cli.error('unknown mode(s): %s' % ', '.join(unknown))
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as fd:
+            baseline = json.load(fd)['results']
+
+    results = []
+    for mode in modes:
+        try:
+            results.append((mode, spawn(mode, opts)))
+        except subprocess.CalledProcessError:
+            print >> sys.stderr, 'mode %s failed, skipping' % mode
+    show(results, baseline)
+
+    if opts.output:
+        params = dict((name, getattr(opts, name)) for name in ('pages',
+            'links', 'size', 'change_rate', 'latency', 'rounds', 'period',
+            'threads', 'extractor', 'seed'))
+        with open(opts.output, 'w') as fd:
+            json.dump({
+              'commit': git_commit(),
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'params': params,
+              'results': dict(results),
+            }, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+
+if __name__ == '__main__':
+    main()
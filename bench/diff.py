@@ -0,0 +1,73 @@
+"""
+Compare the merge-based link diff with difflib.unified_diff on big pages,
+checking that both produce the same output.
+
+    python bench/diff.py [--sizes 1000,10000,100000] [--change 0.01]
+        [--difflib-limit N]
+"""
+import datetime
+import difflib
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from unfurl.diff import unified_diff
+
+def link_lists(size, change, rng):
+    """
+    Two sorted link lists of about ``size`` links, each link of the first
+    removed and a new one added with probability ``change``
+    """
+    old = [ 'http://example.com/page/%08d' % i for i in xrange(size) ]
+    new = []
+    for link in old:
+        if rng.random() >= change:
+            new.append(link)
+        if rng.random() < change:
+            new.append(link + '/new')
+    return old, new
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = list(func(*args, **kwargs))
+    return time.time() - start, result
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--sizes', default='1000,10000,100000',
+      help='comma-separated link counts to diff')
+    cli.add_option('--change', type=float, default=0.01,
+      help='fraction of links removed, and of links added')
+    cli.add_option('--difflib-limit', type=int, default=100000,
+      help="skip difflib above this many links")
+    opts, args = cli.parse_args()
+
+    rng = random.Random(0)
+    now = datetime.datetime.now()
+    print '%10s %10s %14s %14s' % ('links', 'changes', 'difflib (ms)',
+        'merge (ms)')
+    for size in [ int(i) for i in opts.sizes.split(',') ]:
+        old, new = link_lists(size, opts.change, rng)
+        headers = dict(fromfile='u', tofile='u', fromfiledate=now,
+            tofiledate=now, lineterm='')
+
+        merge_time, merged = timed(unified_diff, old, new, **headers)
+        changes = len([ i for i in merged if i[:1] in '+-' ]) - 2
+        if size <= opts.difflib_limit:
+            difflib_time, expected = timed(difflib.unified_diff, old, new,
+                **headers)
+            if merged != expected:
+                raise SystemExit('outputs differ at %d links' % size)
+            difflib_ms = '%.1f' % (difflib_time * 1000)
+        else:
+            difflib_ms = 'skipped'
+
+        print '%10d %10d %14s %14.1f' % (size, changes, difflib_ms,
+            merge_time * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Check that every link extractor backend agrees on a corpus of awkward
+markup, then time them on generated pages of 1k-100k links.
+
+    python bench/extractors.py [--sizes 1000,10000,100000] [--repeat N]
+"""
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from unfurl.extract import EXTRACTORS
+from unfurl.tests.test_extract import CORPUS, available
+
+def check_equivalence(names):
+    failures = 0
+    for markup, regex in CORPUS:
+        results = dict((name, EXTRACTORS[name].extract(markup, regex))
+            for name in names)
+        if len(set(tuple(i) for i in results.values())) > 1:
+            failures += 1
+            print 'MISMATCH for %r (regex %r):' % (markup, regex)
+            for name, links in sorted(results.items()):
+                print '  %-8s %r' % (name, links)
+    return failures
+
+def generate(count):
+    links = ''.join('<li><a class="item" href="http://example.com/page/%d">'
+        'Page %d</a> <a href="#top">top</a></li>\n' % (i, i)
+        for i in xrange(count))
+    return u'<html><head><title>index</title></head><body><ul>\n%s' \
+        u'</ul></body></html>\n' % links
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--sizes', default='1000,10000,100000',
+      help='comma-separated link counts to benchmark')
+    cli.add_option('--repeat', type=int, default=3)
+    opts, args = cli.parse_args()
+
+    names = available()
+    print 'backends: %s' % ', '.join(names)
+
+    failures = check_equivalence(names)
+    print 'equivalence: %d/%d corpus documents agree' % (
+        len(CORPUS) - failures, len(CORPUS))
+
+    for size in [ int(i) for i in opts.sizes.split(',') ]:
+        markup = generate(size)
+        reference = None
+        for name in names:
+            best = None
+            for i in range(opts.repeat):
+                start = time.time()
+                links = EXTRACTORS[name].extract(markup, '^http')
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            reference = reference or links
+            assert links == reference, '%s disagrees on %d links' % (name, size)
+            print '%7d links  %-8s %8.3f s' % (size, name, best)
+
+    if failures:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Time the crawl-time dedup lookup (``Snapshot.exact``) and the latest
+snapshot lookup (``Snapshot.last``) as the snapshot table grows, with and
+without the schema's indexes.
+
+    python bench/index.py [--sizes 10000,100000,1000000] [--urls N]
+"""
+import datetime
+import hashlib
+import optparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from unfurl.db import Database, Snapshot
+from unfurl.page import PageSnapshot
+
+def fill(location, start, stop, urls):
+    conn = sqlite3.connect(location)
+    epoch = datetime.datetime(2014, 1, 1)
+    rows = ((
+        'http://example.com/%d' % (i % urls),
+        epoch + datetime.timedelta(seconds=i),
+        buffer('http://example.com/link/%d' % i),
+        '',
+        '.+',
+        'sha512',
+        buffer(hashlib.sha512(str(i)).digest()),
+      ) for i in xrange(start, stop))
+    conn.executemany('INSERT INTO snapshot (url, created, data, checksum, '
+        'regex, hasher, digest) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+def drop_indexes(location):
+    conn = sqlite3.connect(location)
+    names = conn.execute("SELECT name FROM sqlite_master WHERE "
+      "type = 'index' AND tbl_name = 'snapshot' AND sql IS NOT NULL")
+    for (name,) in names.fetchall():
+        conn.execute('DROP INDEX %s' % name)
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
+    conn.close()
+
+def timed(func, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        func(i)
+    return (time.time() - start) / repeat * 1000
+
+def measure(urls, repeat):
+    def exact(i):
+        Snapshot.exact(PageSnapshot('http://example.com/%d' % (i % urls),
+            ['missing'], '.+'))
+    def last(i):
+        Snapshot.last('http://example.com/%d' % (i % urls))
+    return timed(exact, repeat), timed(last, repeat)
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--sizes', default='10000,100000,1000000',
+      help='comma-separated table sizes to measure at')
+    cli.add_option('--urls', type=int, default=1000,
+      help='number of distinct urls the rows are spread over')
+    cli.add_option('--repeat', type=int, default=200)
+    opts, args = cli.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='unfurl-bench-')
+    try:
+        indexed = os.path.join(workdir, 'indexed.sqlite3')
+        plain = os.path.join(workdir, 'plain.sqlite3')
+        Database(indexed)
+        Database(plain)
+        drop_indexes(plain)
+
+        print '%10s  %-8s %12s %12s' % ('rows', 'schema', 'exact (ms)',
+            'last (ms)')
+        size = 0
+        for target in [ int(i) for i in opts.sizes.split(',') ]:
+            for location in (indexed, plain):
+                fill(location, size, target, opts.urls)
+            size = target
+
+            for name, location in (('indexed', indexed), ('plain', plain)):
+                Database(location)
+                if location == plain:
+                    drop_indexes(plain)
+                exact, last = measure(opts.urls, opts.repeat)
+                print '%10d  %-8s %12.3f %12.3f' % (size, name, exact, last)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Report the crawler's peak resident memory per 10,000 URLs.
+
+Crawls ``--urls`` distinct local pages once each and compares the process'
+peak RSS after setting up the pages with its peak after the crawl.
+
+    python bench/memory.py [--urls N] [--links N] [--threads N]
+        [--extractor NAME]
+"""
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import (
+  peak_rss, serving, temporary_database, make_crawler, make_pages,
+)
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--urls', type=int, default=10000)
+    cli.add_option('--links', type=int, default=200)
+    cli.add_option('--threads', type=int, default=10)
+    cli.add_option('--extractor', default='lxml')
+    opts, args = cli.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with serving() as server, temporary_database() as path:
+        crawler = make_crawler(path, count=1, period=3600, threaded=True,
+            max_threads=opts.threads, extractor=opts.extractor)
+        pages = make_pages('%s/%d?%%d' % (server.url, opts.links), opts.urls)
+        before = peak_rss()
+
+        start = time.time()
+        crawler.crawl(pages)
+        elapsed = time.time() - start
+        after = peak_rss()
+
+    per = 10000.0 / opts.urls
+    print 'urls:              %d (%d links each)' % (opts.urls, opts.links)
+    print 'crawl time:        %.1f s' % elapsed
+    print 'peak rss:          %.1f MiB (%.1f MiB before crawling)' % (
+        after / 1024.0, before / 1024.0)
+    print 'crawl growth:      %.1f MiB per 10k urls' % (
+        (after - before) / 1024.0 * per)
+
+if __name__ == '__main__':
+    main()
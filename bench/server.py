@@ -0,0 +1,142 @@
+"""
+A local stand-in for the sites unfurl crawls.
+
+``/<n>`` serves an HTML page holding ``n`` links (any query string is
+ignored, so ``/<n>?<i>`` gives distinct URLs for the same page).
+
+``/page/<i>`` serves synthetic page ``i``, shaped by the server's settings:
+``links`` links, padded out to ``size`` bytes, answering after
+``latency`` seconds. Each fetch changes the page with probability
+``change_rate`` (rewriting a tenth of its links); pages carry an ``ETag``
+and answer conditional requests for an unchanged page with a 304.
+
+The server speaks keep-alive HTTP/1.1 and can add a fixed delay to every
+new connection to imitate the TCP/TLS handshake cost of a remote host.
+"""
+import BaseHTTPServer
+import SocketServer
+import random
+import threading
+import time
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the response and skip Nagle, or keep-alive requests stall on
+    # delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+        self.server.connections += 1
+
+    def render(self, count):
+        links = ''.join('<a href="http://example.com/%d">%d</a>\n' % (i, i)
+            for i in xrange(count))
+        return '<html><body>\n%s</body></html>\n' % links
+
+    def render_page(self, number, version):
+        server = self.server
+        changed = max(server.links // 10, 1)
+        links = ''.join('<a href="http://example.com/%d/%d%s">%d</a>\n' % (
+            number, i, '/v%d' % version if i < changed else '', i)
+            for i in xrange(server.links))
+        body = '<html><body>\n%s</body></html>\n' % links
+        padding = server.size - len(body) - len('<!--  -->\n')
+        if padding > 0:
+            body += '<!-- %s -->\n' % ('x' * padding)
+        return body
+
+    def send_body(self, body, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/page/'):
+            self.get_page(path)
+            return
+
+        try:
+            count = int(path.strip('/') or 0)
+        except ValueError:
+            self.send_error(404)
+            return
+
+        self.send_body(self.render(count))
+
+    def get_page(self, path):
+        try:
+            number = int(path[len('/page/'):])
+        except ValueError:
+            self.send_error(404)
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        version = self.server.fetched(number)
+        etag = '"%d"' % version
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_body(self.render_page(number, version), [('ETag', etag)])
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # a burst of concurrent connects overflowing the default backlog of 5
+    # stalls on SYN retransmits, a second apiece
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0), connect_delay=0,
+      handler=PageHandler, links=100, size=0, change_rate=0.0, latency=0.0,
+      seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.connect_delay = connect_delay
+        self.connections = 0
+        self.links = links
+        self.size = size
+        self.change_rate = change_rate
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._versions = {}
+
+    def fetched(self, number):
+        """
+        Record a fetch of page ``number``, which may change it, and return
+        the page's version
+        """
+        with self._lock:
+            version = self._versions.get(number, 0)
+            if number in self._versions and \
+              self._random.random() < self.change_rate:
+                version += 1
+            self._versions[number] = version
+        return version
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
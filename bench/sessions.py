@@ -0,0 +1,54 @@
+"""
+Compare per-page fetch latency with and without pooled keep-alive sessions.
+
+    python bench/sessions.py [--pages N] [--connect-delay SECONDS]
+"""
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from server import PageServer
+from unfurl.page import get_page
+from unfurl.session import SessionPool
+
+def run(urls, session_pool=None):
+    start = time.time()
+    for url in urls:
+        session = session_pool and session_pool.get()
+        get_page(url, session=session)
+    return (time.time() - start) / len(urls)
+
+def main():
+    cli = optparse.OptionParser(usage='%prog [options]')
+    cli.add_option('--pages', type=int, default=500)
+    cli.add_option('--links', type=int, default=100)
+    cli.add_option('--connect-delay', type=float, default=0.005,
+      help='simulated handshake cost per new connection (seconds)')
+    opts, args = cli.parse_args()
+
+    server = PageServer(connect_delay=opts.connect_delay).start()
+    urls = [ '%s/%d' % (server.url, opts.links) ] * opts.pages
+
+    server.connections = 0
+    plain = run(urls)
+    plain_connections = server.connections
+
+    server.connections = 0
+    pool = SessionPool()
+    pooled = run(urls, pool)
+    pool.close()
+    pooled_connections = server.connections
+    server.shutdown()
+
+    print 'pages:             %d' % opts.pages
+    print 'no session:        %.3f ms/page (%d connections)' % (
+        plain * 1000, plain_connections)
+    print 'pooled session:    %.3f ms/page (%d connections)' % (
+        pooled * 1000, pooled_connections)
+    print 'saved:             %.3f ms/page' % ((plain - pooled) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 import logging
+import importlib
+import sys
+import types
 
 logging.basicConfig()
 LOG = logging.getLogger(__name__)
@@ -9,6 +12,33 @@ if DEBUG_MODE:
     LOG.setLevel(logging.DEBUG)
     LOG.debug('debug mode enabled via environment')
 
-from unfurl.page import Page, PageSnapshot
-from unfurl.db import Database, Snapshot
-from unfurl.crawler import Crawler
+# name -> module it's imported from the first time it's used, so importing
+# the package (or a light submodule of it) doesn't pull in the crawler
+EXPORTS = {
+  'Page': 'unfurl.page',
+  'PageSnapshot': 'unfurl.page',
+  'Database': 'unfurl.db',
+  'Snapshot': 'unfurl.db',
+  'Crawler': 'unfurl.crawler',
+}
+
+class _Package(types.ModuleType):
+    def __getattr__(self, name):
+        try:
+            module = EXPORTS[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'" % \
+                name)
+        value = getattr(importlib.import_module(module), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(EXPORTS))
+
+_package = _Package(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+# python 2 clears a module's globals when it's collected, and the methods
+# above still use these
+_package._original = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -1,14 +1,23 @@
 import optparse
 import logging
 import sys
-from unfurl import Crawler, Page, Snapshot, Database
-from unfurl.config import DEFAULT_CONFIG, CONFIG, ConfigurationError
+from unfurl.config import (
+  DEFAULT_CONFIG, CONFIG, ConfigurationError, ENGINES, SCHEDULES,
+)
+from unfurl.diff import FORMATS as DIFF_FORMATS
+from unfurl.profiling import PROFILERS, profiled
+from unfurl.util import parse_time, patch_for_gevent
+import socket
 import sqlite3
 
+# each command imports the rest of unfurl (and so requests, peewee, bs4 and
+# friends) as it needs it, keeping startup cheap for the quick ones
+
 LOG = logging.getLogger(__name__)
 
 class UnfurlOptionParser(optparse.OptionParser):
     def load_database(self):
+        from unfurl.db import Database
         try:
             return Database()
         except Exception, e:
@@ -40,6 +49,24 @@ def get_cli():
       help='enable debug output')
     return cli
 
+def add_profile_options(cli):
+    cli.add_option('--profile', metavar='FILE',
+      help='Profile the command, saving the results to FILE (pstats, or '
+           'collapsed stacks for flame graphs with --profiler=sampling) and '
+           'printing the top hot spots at exit')
+    cli.add_option('--profiler', type='choice', choices=PROFILERS,
+      default='deterministic',
+      help='Profiler to use: deterministic (cProfile, in every thread) or '
+           'sampling (wall-clock stacks of every thread). Defaults to '
+           'deterministic.')
+    cli.add_option('--profile-interval', type=float, default=0.005,
+      help='Seconds between samples for the sampling profiler (defaults to '
+           '0.005)')
+
+def profile(opts):
+    return profiled(opts.profile, profiler=opts.profiler,
+        interval=opts.profile_interval)
+
 def get_crawl_cli():
     cli = UnfurlOptionParser(prog='unfurl crawl',
         usage='unfurl crawl <url> [url, url, ...] [options]')
@@ -47,12 +74,99 @@ def get_crawl_cli():
       help='Time in seconds between crawls (defaults to 1 hour)')
     cli.add_option('-c', '--count', type=int,
       help='Crawl a specified number of times (defaults to forever)')
+    cli.add_option('-s', '--schedule', type='choice', choices=SCHEDULES,
+      help='How crawl periods are chosen: fixed, or adaptive to how often '
+           'each page changes (defaults to fixed)')
     cli.add_option('-m', '--max-threads', type=int,
       help='Maximum number of threads to use for crawling')
+    cli.add_option('-P', '--parse-processes', type=int,
+      help='Number of processes to parse pages in (defaults to 0, parse '
+           'in the crawling threads)')
+    cli.add_option('-x', '--extractor',
+      help='Link extractor backend: soup, stream or lxml (defaults to soup)')
+    cli.add_option('--host-concurrency', type=int,
+      help='Maximum number of simultaneous requests to any one host '
+           '(defaults to 0, unlimited)')
+    cli.add_option('--host-delay', type=float,
+      help='Minimum seconds between the start of requests to the same host '
+           '(defaults to 0)')
     cli.add_option('--threading', action='store_true',
       help='Whether to enable multi-threaded mode (defaults to false)')
+    cli.add_option('-e', '--engine', type='choice', choices=ENGINES,
+      help='Crawl engine to use: %s (defaults to thread)' % ', '.join(ENGINES))
+    cli.add_option('--concurrency', type=int,
+      help='Maximum number of in-flight fetches for the async engine')
+    cli.add_option('--metrics-listen',
+      help='Serve Prometheus metrics over HTTP on this [host:]port')
+    cli.add_option('--metrics-file',
+      help='Periodically write Prometheus metrics to this file')
+    add_profile_options(cli)
     return cli
 
+def get_metrics_exporters(listen, filename, interval):
+    from unfurl.exposition import MetricsServer, MetricsFile
+    exporters = []
+    if listen:
+        host, _, port = listen.rpartition(':')
+        exporters.append(MetricsServer((host or '127.0.0.1', int(port))))
+    if filename:
+        exporters.append(MetricsFile(filename, interval=interval))
+    return exporters
+
+def get_crawler(opts, **overrides):
+    """
+    A ``Crawler`` set up from the config file, except where the command
+    line (``opts``) or ``overrides`` say otherwise
+    """
+    from unfurl.crawler import Crawler, HostLimits, CircuitBreaker
+    from unfurl.session import SessionPool
+    # commands other than crawl only have some of its options
+    option = lambda name: getattr(opts, name, None)
+    options = dict(
+      period=CONFIG.prefer(option('period'), 'crawler', 'period'),
+      count=CONFIG.prefer(option('count'), 'crawler', 'count'),
+      threaded=CONFIG.prefer(option('threading'), 'crawler', 'threaded'),
+      max_threads=CONFIG.prefer(option('max_threads'), 'crawler',
+        'max_threads'),
+      engine=CONFIG.prefer(option('engine'), 'crawler', 'engine'),
+      concurrency=CONFIG.prefer(option('concurrency'), 'crawler',
+        'concurrency'),
+      parse_processes=CONFIG.prefer(option('parse_processes'), 'crawler',
+        'parse_processes'),
+      extractor=CONFIG.prefer(option('extractor'), 'crawler', 'extractor'),
+      write_batch_size=CONFIG.get('crawler', 'write_batch_size'),
+      write_interval=CONFIG.get('crawler', 'write_interval'),
+      hosts=HostLimits(
+        concurrency=CONFIG.prefer(option('host_concurrency'), 'crawler',
+          'host_concurrency'),
+        delay=CONFIG.prefer(option('host_delay'), 'crawler', 'host_delay'),
+        overrides=CONFIG.hosts,
+      ),
+      schedule=CONFIG.prefer(option('schedule'), 'crawler', 'schedule'),
+      min_period=CONFIG.get('crawler', 'min_period'),
+      max_period=CONFIG.get('crawler', 'max_period'),
+      history=CONFIG.get('crawler', 'history'),
+      connect_timeout=CONFIG.get('crawler', 'connect_timeout'),
+      read_timeout=CONFIG.get('crawler', 'read_timeout'),
+      retries=CONFIG.get('crawler', 'retries'),
+      retry_backoff=CONFIG.get('crawler', 'retry_backoff'),
+      max_size=CONFIG.get('crawler', 'max_size'),
+      content_types=CONFIG.get('crawler', 'content_types'),
+      stream_parse=CONFIG.get('crawler', 'stream_parse'),
+      hasher=CONFIG.get('global', 'hasher'),
+      breaker=CircuitBreaker(
+        threshold=CONFIG.get('crawler', 'breaker_threshold'),
+        cooldown=CONFIG.get('crawler', 'breaker_cooldown'),
+      ),
+      sessions=SessionPool(
+        pool_connections=CONFIG.get('crawler', 'pool_connections'),
+        pool_maxsize=CONFIG.get('crawler', 'pool_maxsize'),
+        shared=CONFIG.get('crawler', 'shared_session'),
+      ),
+    )
+    options.update(overrides)
+    return Crawler(**options)
+
 def get_diff_cli():
     cli = UnfurlOptionParser(prog='unfurl diff',
         usage='unfurl diff <url> [options]')
@@ -62,6 +176,10 @@ def get_diff_cli():
     cli.add_option('-n', '--new', type=int, default=0,
       help='Offset of the "old" snapshot (0 is latest, 1 is next oldest, etc.)'
            ' Defaults to 0.')
+    cli.add_option('-f', '--format', type='choice', choices=DIFF_FORMATS,
+      default='unified',
+      help='Output format: %s (defaults to unified)' % ', '.join(DIFF_FORMATS))
+    add_profile_options(cli)
     return cli
 
 def get_dump_cli():
@@ -70,6 +188,73 @@ def get_dump_cli():
     cli.add_option('-o', '--offset', type=int, default=1,
       help='Offset of the snapshot to dump (0 is latest, 1 is next oldest, etc.)'
            ' Defaults to 0 (latest).')
+    add_profile_options(cli)
+    return cli
+
+def get_compact_cli():
+    cli = UnfurlOptionParser(prog='unfurl compact',
+        usage='unfurl compact [url, url, ...] [options]')
+    cli.add_option('-a', '--keep-all-days', type=int,
+      help='Keep every snapshot this many days old or newer (defaults to 30)')
+    cli.add_option('-d', '--keep-daily-days', type=int,
+      help='Keep one snapshot per day up to this many days old, and one per '
+           'week beyond (defaults to 365)')
+    cli.add_option('-l', '--collect-links', action='store_true',
+      help='Also delete interned links no snapshot uses any more')
+    cli.add_option('-n', '--dry-run', action='store_true', default=False,
+      help='Report what would be deleted without deleting it')
+    return cli
+
+def get_report_cli():
+    cli = UnfurlOptionParser(prog='unfurl report',
+        usage='unfurl report [url, url, ...] [options]')
+    cli.add_option('-s', '--since', default='1d',
+      help='Report changes from this time: a date ("2014-01-31 12:00") or '
+           'a time ago ("12h", "7d"). Defaults to 1d.')
+    cli.add_option('-u', '--until',
+      help='Report changes up to this time (defaults to now)')
+    cli.add_option('-m', '--match',
+      help='Only report urls matching this glob pattern')
+    cli.add_option('-f', '--format', type='choice', choices=DIFF_FORMATS,
+      default='unified',
+      help='Output format: %s (defaults to unified)' % ', '.join(DIFF_FORMATS))
+    cli.add_option('-P', '--processes', type=int, default=0,
+      help='Number of processes to compute diffs in (defaults to 0, in '
+           'this process)')
+    return cli
+
+def get_export_cli():
+    from unfurl.export import FORMATS, DEFAULT_FORMAT
+    cli = UnfurlOptionParser(prog='unfurl export',
+        usage='unfurl export [url, url, ...] [options]')
+    cli.add_option('-s', '--since',
+      help='Export snapshots from this time: a date ("2014-01-31 12:00") or '
+           'a time ago ("12h", "7d"). Defaults to the first one.')
+    cli.add_option('-u', '--until',
+      help='Export snapshots up to this time (defaults to now)')
+    cli.add_option('-m', '--match',
+      help='Only export urls matching this glob pattern')
+    cli.add_option('-f', '--format', type='choice', choices=sorted(FORMATS),
+      default=DEFAULT_FORMAT,
+      help='Output format: %s (defaults to %s)' % \
+        (', '.join(sorted(FORMATS)), DEFAULT_FORMAT))
+    cli.add_option('-o', '--output',
+      help='File to write the export to (defaults to standard output)')
+    return cli
+
+def get_import_cli():
+    from unfurl.export import FORMATS, DEFAULT_FORMAT
+    cli = UnfurlOptionParser(prog='unfurl import',
+        usage='unfurl import <file> [options]')
+    cli.add_option('-f', '--format', type='choice', choices=sorted(FORMATS),
+      default=DEFAULT_FORMAT,
+      help='Format of the export: %s (defaults to %s)' % \
+        (', '.join(sorted(FORMATS)), DEFAULT_FORMAT))
+    cli.add_option('-b', '--batch-size', type=int, default=10000,
+      help='Number of snapshots to commit per transaction (defaults to '
+           '10000)')
+    cli.add_option('-a', '--append', action='store_true', default=False,
+      help='Add to a database that already has snapshots')
     return cli
 
 def get_snap_cli():
@@ -82,6 +267,7 @@ def main_main(argv):
     opts, args = cli.parse_args(['-h'])
 
 def main_diff(argv):
+    from unfurl.db import Snapshot
     cli = get_diff_cli()
     opts, args = cli.parse_args(argv)
 
@@ -90,8 +276,10 @@ def main_diff(argv):
 
     cli.load_environment()
 
-    diff = Snapshot.diff(args[0], old_offset=opts.old, new_offset=opts.new)
-    sys.stdout.write(diff)
+    with profile(opts):
+        diff = Snapshot.diff(args[0], old_offset=opts.old,
+            new_offset=opts.new, format=opts.format)
+        sys.stdout.write(diff)
 
 def main_crawl(argv):
     cli = get_crawl_cli()
@@ -102,17 +290,38 @@ def main_crawl(argv):
 
     cli.load_environment()
 
-    crawler = Crawler(
-      period=CONFIG.prefer(opts.period, 'crawler', 'period'),
-      count=CONFIG.prefer(opts.count, 'crawler', 'count'),
-      threaded=CONFIG.prefer(opts.threading, 'crawler', 'threaded'),
-      max_threads=CONFIG.prefer(opts.max_threads, 'crawler', 'max_threads')
-    )
+    # before the crawler brings in requests (and with it ssl)
+    if CONFIG.prefer(opts.engine, 'crawler', 'engine') == 'async':
+        patch_for_gevent()
+
+    from unfurl.crawler import EngineUnavailable
+    from unfurl.extract import ExtractorUnavailable
+    from unfurl.hashing import HasherUnavailable
+    from unfurl.page import Page
+
+    try:
+        exporters = get_metrics_exporters(
+          CONFIG.prefer(opts.metrics_listen, 'metrics', 'listen'),
+          CONFIG.prefer(opts.metrics_file, 'metrics', 'file'),
+          CONFIG.get('metrics', 'interval'),
+        )
+    except (ValueError, socket.error), e:
+        cli.error('could not set up metrics: %s' % e)
+
+    try:
+        crawler = get_crawler(opts, exporters=exporters)
+    except (EngineUnavailable, ExtractorUnavailable, HasherUnavailable), e:
+        cli.error(e.args[0])
+
     pages = list(set(args + CONFIG.pages))
-    pages = [ Page(i) for i in pages ]
-    crawler.crawl(pages)
+    pages = [ Page(i, period=CONFIG.page_period(i)) for i in pages ]
+    with profile(opts):
+        crawler.crawl(pages)
 
 def main_snap(argv):
+    from unfurl.extract import ExtractorUnavailable
+    from unfurl.hashing import HasherUnavailable
+    from unfurl.page import Page
     cli = get_snap_cli()
     opts, args = cli.parse_args(argv)
 
@@ -121,10 +330,16 @@ def main_snap(argv):
 
     cli.load_environment()
 
-    crawler = Crawler(period=0, count=1, threaded=False, log_level=logging.NOTSET)
+    # fetched, parsed and hashed as crawl would, but just the once, inline
+    try:
+        crawler = get_crawler(opts, period=0, count=1, threaded=False,
+            engine='thread', parse_processes=0, log_level=logging.NOTSET)
+    except (ExtractorUnavailable, HasherUnavailable), e:
+        cli.error(e.args[0])
     crawler.crawl([ Page(args[0]) ])
 
 def main_dump(argv):
+    from unfurl.db import Snapshot
     cli = get_dump_cli()
     opts, args = cli.parse_args(argv)
 
@@ -133,16 +348,136 @@ def main_dump(argv):
 
     cli.load_environment()
 
-    success = Snapshot.dump(url=args[0])
+    with profile(opts):
+        success = Snapshot.dump(url=args[0])
 
     if not success:
         abort('no snapshots for that url')
 
+def main_compact(argv):
+    from unfurl.db import Retention
+    cli = get_compact_cli()
+    opts, args = cli.parse_args(argv)
+
+    cli.load_config()
+    db = cli.load_database()
+
+    retention = Retention(
+      keep_all_days=CONFIG.prefer(opts.keep_all_days, 'retention',
+        'keep_all_days'),
+      keep_daily_days=CONFIG.prefer(opts.keep_daily_days, 'retention',
+        'keep_daily_days'),
+    )
+    batch_size = CONFIG.get('retention', 'batch_size')
+
+    removed = 0
+    for url in args or [None]:
+        removed += db.compact(retention, url=url, batch_size=batch_size,
+            dry_run=opts.dry_run)
+    sys.stdout.write('snapshots removed: %d\n' % removed)
+
+    if CONFIG.prefer(opts.collect_links, 'retention', 'collect_links'):
+        links = db.collect_links(dry_run=opts.dry_run)
+        sys.stdout.write('links removed: %d\n' % links)
+
+    if not opts.dry_run:
+        pages = db.vacuum(CONFIG.get('global', 'auto_vacuum'))
+        sys.stdout.write('pages freed: %d\n' % pages)
+
+def main_report(argv):
+    from unfurl.report import report
+    cli = get_report_cli()
+    opts, args = cli.parse_args(argv)
+
+    try:
+        since = parse_time(opts.since)
+        until = opts.until and parse_time(opts.until)
+    except ValueError, e:
+        cli.error(e.args[0])
+
+    cli.load_environment()
+
+    diffs = report(since=since, until=until, urls=args, match=opts.match,
+        format=opts.format, processes=opts.processes)
+    for diff in diffs:
+        sys.stdout.write(diff)
+
+def main_export(argv):
+    from unfurl.export import export_snapshots, get_format, FormatUnavailable
+    cli = get_export_cli()
+    opts, args = cli.parse_args(argv)
+
+    try:
+        since = opts.since and parse_time(opts.since)
+        until = opts.until and parse_time(opts.until)
+    except ValueError, e:
+        cli.error(e.args[0])
+
+    # before the output file is opened (and truncated)
+    try:
+        get_format(opts.format)
+    except FormatUnavailable, e:
+        cli.error(e.args[0])
+
+    cli.load_environment()
+
+    try:
+        fd = open(opts.output, 'wb') if opts.output else sys.stdout
+    except IOError, e:
+        abort('could not write %s: %s' % (opts.output, e.strerror))
+    try:
+        count = export_snapshots(fd, format=opts.format, since=since,
+            until=until, urls=args, match=opts.match)
+    finally:
+        if opts.output:
+            fd.close()
+    LOG.info('exported %d snapshots' % count)
+
+def main_import(argv):
+    from unfurl.db import Snapshot
+    from unfurl.export import (
+      import_snapshots, get_format, FormatUnavailable, BUFFER_SIZE,
+    )
+    cli = get_import_cli()
+    opts, args = cli.parse_args(argv)
+
+    if len(args) != 1:
+        cli.error('requires a file to import ("-" for standard input)')
+
+    try:
+        get_format(opts.format)
+    except FormatUnavailable, e:
+        cli.error(e.args[0])
+
+    cli.load_config()
+    db = cli.load_database()
+
+    if not opts.append and Snapshot.select().exists():
+        abort('the database already has snapshots (use --append to add to '
+            'them)')
+
+    try:
+        fd = sys.stdin if args[0] == '-' else open(args[0], 'rb', BUFFER_SIZE)
+    except IOError, e:
+        abort('could not read %s: %s' % (args[0], e.strerror))
+    try:
+        count = import_snapshots(db, fd, format=opts.format,
+            batch_size=opts.batch_size)
+    except (ValueError, KeyError, TypeError), e:
+        abort('could not understand %s: %s' % (args[0], e))
+    finally:
+        fd.close()
+    sys.stdout.write('snapshots imported: %d\n' % count)
+
 COMMANDS = {
   'diff': main_diff,
   'crawl': main_crawl,
   'snap': main_snap,
   'dump': main_dump,
+  'compact': main_compact,
+  'report': main_report,
+  'export': main_export,
+  'import': main_import,
 }
 
 def main(argv=None):
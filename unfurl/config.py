@@ -53,6 +53,30 @@ def resolve_database(precedence=None):
         result = MEMORY_DATABASE
     return result
 
+# crawl engines: 'thread' runs the (optionally threaded) executor, 'async'
+# runs gevent greenlets
+ENGINES = ('thread', 'async')
+
+# how pages' crawl periods are chosen: 'fixed' uses the configured period,
+# 'adaptive' follows each page's observed rate of change
+SCHEDULES = ('fixed', 'adaptive')
+
+# sections named "host:<host>" hold per-host crawl politeness settings
+HOST_PREFIX = 'host:'
+
+# how snapshot link lists are stored (see unfurl.db)
+STORAGE_MODES = ('raw', 'zlib', 'interned')
+
+# how snapshot checksums are shown
+CHECKSUM_ENCODINGS = ('hex', 'base64')
+
+# values for sqlite's synchronous pragma
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+
+# values for sqlite's auto_vacuum pragma, in the order of the numbers it
+# reports them as
+AUTO_VACUUM_MODES = ('none', 'full', 'incremental')
+
 def create_environment(umask=0022):
     os.umask(umask)
 
@@ -61,9 +85,6 @@ def create_environment(umask=0022):
     else:
         os.makedirs(DEFAULT_USER_DIR)
 
-CONFIG_FILE = resolve_config_file()
-DATABASE = resolve_database()
-
 class ConfigurationError(RuntimeError): 
     def __init__(self, exception):
         self.exception = exception
@@ -74,26 +95,86 @@ class ConfigurationError(RuntimeError):
 class Configuration(object):
     defaults = {
       'global': {
-        'database': DATABASE,
+        # 'database' is resolved when the configuration is first used
         'log_level': 'INFO',
+        'journal_mode': 'wal',
+        'auto_vacuum': 'incremental',
+        'synchronous': 'normal',
+        'cache_size': '-16000',
+        'storage': 'raw',
+        'hasher': 'sha512',
+        'checksum_encoding': 'hex',
       },
       'crawler': {
         'count': '-1',
         'period': '3600',
         'max_threads': '5',
         'threaded': 'false',
+        'pool_connections': '10',
+        'pool_maxsize': '10',
+        'shared_session': 'false',
+        'engine': 'thread',
+        'concurrency': '1000',
+        'parse_processes': '0',
+        'extractor': 'soup',
+        'write_batch_size': '500',
+        'write_interval': '1.0',
+        'host_concurrency': '0',
+        'host_delay': '0',
+        'schedule': 'fixed',
+        'min_period': '60',
+        'max_period': '86400',
+        'history': '10',
+        'connect_timeout': '10',
+        'read_timeout': '30',
+        'retries': '2',
+        'retry_backoff': '0.5',
+        'breaker_threshold': '5',
+        'breaker_cooldown': '300',
+        'max_size': '10485760',
+        'content_types': 'text/html, application/xhtml+xml',
+        'stream_parse': 'false',
+      },
+      'metrics': {
+        'listen': '',
+        'file': '',
+        'interval': '15',
+      },
+      'retention': {
+        'keep_all_days': '30',
+        'keep_daily_days': '365',
+        'batch_size': '1000',
+        'collect_links': 'false',
       },
     }
 
-    def __init__(self, filename=None, autoload=False):
-        self.filename = filename
-        self._conf = ConfigParser.RawConfigParser(self.defaults)
-        self._set_defaults()
+    def __init__(self, filename=None, autoload=False, precedence=None):
+        """
+        Read ``filename``, or the first existing file in ``precedence``
+        (resolved when the configuration is first used)
+        """
+        self._filename = filename
+        self._precedence = precedence
+        self.__conf = None
         self._loaded = False
 
         if autoload:
             self.load()
 
+    @property
+    def filename(self):
+        if self._filename is None and self._precedence:
+            self._filename = resolve_config_file(self._precedence)
+        return self._filename
+
+    @property
+    def _conf(self):
+        # nothing is looked up on disk until the configuration is used
+        if self.__conf is None:
+            self.__conf = ConfigParser.RawConfigParser(self.defaults)
+            self._set_defaults()
+        return self.__conf
+
     @property
     def loaded(self):
         return self._loaded
@@ -118,6 +199,7 @@ class Configuration(object):
             self._add_section(section)
             for key, val in section_data.iteritems():
                 self._set(section, key, val)
+        self._set('global', 'database', resolve_database())
 
     def _get(self, section, key, default=None):
         try:
@@ -153,6 +235,36 @@ class Configuration(object):
                 raise OSError(errno.EEXIST, 
                   'database directory "%s" does not exist' % db_dir)
 
+        synchronous = self._get('global', 'synchronous')
+        if synchronous.lower() not in SYNCHRONOUS_MODES:
+            raise ValueError('unknown synchronous mode "%s" (choose from: '
+                '%s)' % (synchronous, ', '.join(SYNCHRONOUS_MODES)))
+
+        auto_vacuum = self._get('global', 'auto_vacuum')
+        if auto_vacuum.lower() not in AUTO_VACUUM_MODES:
+            raise ValueError('unknown auto_vacuum mode "%s" (choose from: '
+                '%s)' % (auto_vacuum, ', '.join(AUTO_VACUUM_MODES)))
+
+        storage = self._get('global', 'storage')
+        if storage not in STORAGE_MODES:
+            raise ValueError('unknown storage mode "%s" (choose from: %s)' % \
+                (storage, ', '.join(STORAGE_MODES)))
+
+        checksum_encoding = self._get('global', 'checksum_encoding')
+        if checksum_encoding not in CHECKSUM_ENCODINGS:
+            raise ValueError('unknown checksum encoding "%s" (choose from: '
+                '%s)' % (checksum_encoding, ', '.join(CHECKSUM_ENCODINGS)))
+
+        schedule = self._get('crawler', 'schedule')
+        if schedule not in SCHEDULES:
+            raise ValueError('unknown schedule "%s" (choose from: %s)' % \
+                (schedule, ', '.join(SCHEDULES)))
+
+        engine = self._get('crawler', 'engine')
+        if engine not in ENGINES:
+            raise ValueError('unknown crawl engine "%s" (choose from: %s)' % \
+                (engine, ', '.join(ENGINES)))
+
     def _convert(self, section, key, callable, getter=None, setter=None):
         getter = getter or self._get
         setter = setter or self._set
@@ -167,6 +279,9 @@ class Configuration(object):
     def _boolean(self, item):
         return item.lower().strip() == 'true'
 
+    def _list(self, item):
+        return [ i.strip().lower() for i in item.split(',') if i.strip() ]
+
     def _log_level(self, item):
         level = getattr(logging, item.upper(), 'INFO')
 
@@ -176,10 +291,38 @@ class Configuration(object):
         """
         self._convert_sections()
         self._convert_page_sections()
+        self._convert_host_sections()
         self._convert('crawler', 'period', int)
         self._convert('crawler', 'count', int)
         self._convert('crawler', 'max_threads', int)
         self._convert('crawler', 'threaded', self._boolean)
+        self._convert('crawler', 'pool_connections', int)
+        self._convert('crawler', 'pool_maxsize', int)
+        self._convert('crawler', 'shared_session', self._boolean)
+        self._convert('crawler', 'concurrency', int)
+        self._convert('crawler', 'parse_processes', int)
+        self._convert('crawler', 'write_batch_size', int)
+        self._convert('crawler', 'write_interval', float)
+        self._convert('crawler', 'host_concurrency', int)
+        self._convert('crawler', 'host_delay', float)
+        self._convert('crawler', 'min_period', int)
+        self._convert('crawler', 'max_period', int)
+        self._convert('crawler', 'history', int)
+        self._convert('crawler', 'connect_timeout', float)
+        self._convert('crawler', 'read_timeout', float)
+        self._convert('crawler', 'retries', int)
+        self._convert('crawler', 'retry_backoff', float)
+        self._convert('crawler', 'breaker_threshold', int)
+        self._convert('crawler', 'breaker_cooldown', int)
+        self._convert('crawler', 'max_size', int)
+        self._convert('crawler', 'content_types', self._list)
+        self._convert('crawler', 'stream_parse', self._boolean)
+        self._convert('global', 'cache_size', int)
+        self._convert('metrics', 'interval', float)
+        self._convert('retention', 'keep_all_days', int)
+        self._convert('retention', 'keep_daily_days', int)
+        self._convert('retention', 'batch_size', int)
+        self._convert('retention', 'collect_links', self._boolean)
         db = self._get('global', 'database')
         if db != MEMORY_DATABASE:
             self._convert('global', 'database', fullpath)
@@ -224,10 +367,42 @@ class Configuration(object):
         for section in self._page_sections():
             if not self._get(section, 'url'):
                 self._set(section, 'url', section)
+            if self._get(section, 'period') is not None:
+                self._convert(section, 'period', int)
+
+    def _host_sections(self):
+        return [ i for i in self._sections() if i.startswith(HOST_PREFIX) ]
+
+    def _convert_host_sections(self):
+        for section in self._host_sections():
+            if self._get(section, 'concurrency') is not None:
+                self._convert(section, 'concurrency', int)
+            if self._get(section, 'delay') is not None:
+                self._convert(section, 'delay', float)
+
+    @property
+    def hosts(self):
+        """
+        Per-host politeness overrides from ``[host:<host>]`` sections, as a
+        dict of host to ``concurrency`` and/or ``delay``
+        """
+        self.ensure_loaded()
+        result = {}
+        for section in self._host_sections():
+            host = section[len(HOST_PREFIX):].strip().lower()
+            result[host] = dict((key, self._get(section, key)) for key in \
+                ('concurrency', 'delay') if self._get(section, key) is not None)
+        return result
+
+    def page_period(self, url):
+        """
+        The crawl period configured for the page section ``url``, if any
+        """
+        return self.get(url, 'period')
 
     @property
     def pages(self):
         return self._page_sections()
 
-DEFAULT_CONFIG = Configuration(autoload=True)
-CONFIG = Configuration(CONFIG_FILE)
+DEFAULT_CONFIG = Configuration()
+CONFIG = Configuration(precedence=CONFIG_PRECEDENCE)
@@ -1,14 +1,34 @@
 import logging
 import time
 import re
-from unfurl import Database, Snapshot
+from unfurl.db import Database, Snapshot, Writer
+from unfurl.page import PageSnapshot, parse_markup
+from unfurl.extract import get_extractor, DEFAULT_EXTRACTOR
+from unfurl.hashing import get_hasher, DEFAULT_HASHER
+from unfurl.session import SessionPool
+from unfurl.metrics import REGISTRY, stage
+from unfurl.util import Counters, ignore_interrupts, patch_for_gevent
+import collections
+import datetime
+import heapq
+import itertools
+import multiprocessing
 import Queue
+import sys
 import threading
-import signal
+try:
+    import gevent.monkey
+    import gevent.pool
+except ImportError:
+    gevent = None
 
 LOG = logging.getLogger(__name__)
 
 class Executor(object):
+    """
+    Runs ``callable`` on submitted items, either inline or on a pool of
+    ``max_threads`` long-lived worker threads.
+    """
     def __init__(self, callable, threaded=True, max_threads=10):
         LOG.info('max threads: %s' % max_threads)
         LOG.info('threaded mode enabled? %s' % threaded)
@@ -22,53 +42,386 @@ class Executor(object):
 
         self._shutdown = threading.Event()
 
-    def _worker(self):
-        while not self._shutdown.is_set():
-            try:
-                # the queue is fully populated from thread start, so no need
-                # to block for work
-                item = self._queue.get(timeout=1)
-            except Queue.Empty:
-                # empty queue == no more work == exit thread
-                return
-            self._callable(item)
-            self._queue.task_done()
+    @property
+    def capacity(self):
+        """
+        How many items can usefully be in flight at once
+        """
+        return self._max_threads if self.threaded else 1
+
+    def start(self):
+        if not self.threaded or self._living_workers():
+            return
 
-    def _work_threaded(self, items):
+        self._shutdown.clear()
         for i in range(self._max_threads):
             t = threading.Thread(target=self._worker)
             self._worker_threads.append(t)
             t.daemon = True
             t.start()
 
-        for item in items:
-            self._queue.put(item)
-
-        self._queue.join()
+    def _worker(self):
+        while not self._shutdown.is_set():
+            try:
+                job = self._queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            try:
+                if job is None:
+                    # woken up by shutdown()
+                    continue
+                self._run(*job)
+            finally:
+                self._queue.task_done()
 
-    def _work_unthreaded(self, items):
-        for item in items:
+    def _run(self, item, callback):
+        try:
             self._callable(item)
+        except Exception, e:
+            LOG.exception('caught unhandled exception')
+        if callback:
+            try:
+                callback(item)
+            except Exception, e:
+                LOG.exception('caught unhandled exception in callback')
 
-    def work_on(self, items):
+    def submit(self, item, callback=None):
+        """
+        Run ``callable`` on ``item``, then ``callback`` (if given) on it
+        """
         if self.threaded:
-            self._work_threaded(items)
+            self.start()
+            self._queue.put((item, callback))
         else:
-            self._work_unthreaded(items)
+            self._run(item, callback)
+
+    def join(self):
+        """
+        Block until every submitted item has been handled
+        """
+        if self.threaded:
+            self._queue.join()
+
+    def work_on(self, items):
+        for item in items:
+            self.submit(item)
+        self.join()
 
     def shutdown(self):
         LOG.debug('attempting to shut down worker threads')
         self._shutdown.set()
+        for t in self._living_workers():
+            self._queue.put(None)
 
         while self._living_workers():
-            time.sleep(0.5)
+            time.sleep(0.05)
+
+        self._worker_threads = []
 
     def _living_workers(self):
         return [ t for t in self._worker_threads if t.isAlive() ]
 
+class EngineUnavailable(RuntimeError): pass
+
+class AsyncExecutor(Executor):
+    """
+    Runs ``callable`` on submitted items as gevent greenlets, so thousands
+    of fetches can wait on the network at once without an OS thread
+    apiece. Requires ``gevent``. The standard library should already be
+    monkey-patched (see ``unfurl.util.patch_for_gevent``); if it isn't, it
+    is patched the first time an instance is created, too late for modules
+    that are already imported.
+    """
+    def __init__(self, callable, concurrency=1000):
+        if gevent is None:
+            raise EngineUnavailable('the async engine requires gevent')
+
+        LOG.info('async engine concurrency: %s' % concurrency)
+        if not gevent.monkey.is_module_patched('socket'):
+            if 'ssl' in sys.modules:
+                LOG.warning('patching for gevent after ssl was imported, '
+                    'which gevent does not support; call patch_for_gevent '
+                    'before importing the crawler')
+            patch_for_gevent()
+
+        self.threaded = False
+        self._callable = callable
+        self._concurrency = concurrency
+        self._pool = gevent.pool.Pool(concurrency)
+
+    @property
+    def capacity(self):
+        return self._concurrency
+
+    def start(self):
+        pass
+
+    def submit(self, item, callback=None):
+        self._pool.spawn(self._run, item, callback)
+
+    def join(self):
+        self._pool.join()
+
+    def shutdown(self):
+        LOG.debug('attempting to stop greenlets')
+        self._pool.kill()
+
+class Schedule(object):
+    """
+    Items ordered by the time they are next due
+    """
+    def __init__(self):
+        self._heap = []
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, due, item):
+        with self._lock:
+            # the sequence number keeps equally-due items in FIFO order
+            heapq.heappush(self._heap, (due, next(self._sequence), item))
+
+    def next_due(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """
+        Remove and return ``(due, item)`` for the earliest item due by
+        ``now``, or ``None``
+        """
+        with self._lock:
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            due, sequence, item = heapq.heappop(self._heap)
+            return due, item
+
+class HostLimits(object):
+    """
+    Per-host politeness. Pages that are due wait here, queued by host, and
+    are handed out round-robin across hosts so a single large site can't
+    starve the others. A host only gets another request while it has fewer
+    than ``concurrency`` in flight (0 means no limit) and at least
+    ``delay`` seconds have passed since its last request started.
+
+    ``overrides`` maps a host to a dict with its own ``concurrency``
+    and/or ``delay``.
+    """
+    def __init__(self, concurrency=0, delay=0, overrides=None):
+        LOG.info('per-host concurrency: %s' % (concurrency or 'unlimited'))
+        LOG.info('per-host delay: %s' % delay)
+        self.concurrency = concurrency
+        self.delay = delay
+        self.overrides = overrides or {}
+
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._hosts = collections.deque()
+        self._in_flight = collections.defaultdict(int)
+        self._last_start = {}
+        self._waiting = 0
+
+    def __len__(self):
+        return self._waiting
+
+    def limits(self, host):
+        override = self.overrides.get(host, {})
+        return override.get('concurrency', self.concurrency), \
+               override.get('delay', self.delay)
+
+    def add(self, host, item):
+        if host not in self._ready:
+            self._ready[host] = collections.deque()
+            self._hosts.append(host)
+        self._ready[host].append(item)
+        self._waiting += 1
+
+    def _allowed(self, host, now):
+        concurrency, delay = self.limits(host)
+        if concurrency and self._in_flight[host] >= concurrency:
+            return False
+        return now - self._last_start.get(host, 0) >= delay
+
+    def take(self, now):
+        """
+        Return ``(host, item)`` for the next item that may start now, or
+        ``None``
+        """
+        for i in range(len(self._hosts)):
+            host = self._hosts.popleft()
+            queue = self._ready[host]
+
+            if not self._allowed(host, now):
+                self._hosts.append(host)
+                continue
+
+            item = queue.popleft()
+            if queue:
+                self._hosts.append(host)
+            else:
+                del self._ready[host]
+            self._waiting -= 1
+
+            with self._lock:
+                self._in_flight[host] += 1
+            self._last_start[host] = now
+            return host, item
+
+        return None
+
+    def release(self, host):
+        with self._lock:
+            self._in_flight[host] -= 1
+
+class CircuitBreaker(object):
+    """
+    Stops fetching from a host once ``threshold`` consecutive fetches from
+    it have failed (0 disables the breaker). After ``cooldown`` seconds a
+    single trial fetch is let through: if it succeeds the host is closed
+    again, otherwise it stays open for another cooldown.
+    """
+    def __init__(self, threshold=5, cooldown=300):
+        LOG.info('circuit breaker threshold: %s' % (threshold or 'disabled'))
+        LOG.info('circuit breaker cooldown: %s' % cooldown)
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._open_until = {}
+
+    def allow(self, host, now):
+        with self._lock:
+            open_until = self._open_until.get(host)
+            if open_until is None:
+                return True
+            if now < open_until:
+                return False
+            # half-open: let this fetch through as the trial, and hold
+            # everything else back until it reports in
+            self._open_until[host] = now + self.cooldown
+            return True
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._open_until.pop(host, None)
+
+    def failure(self, host, now):
+        """
+        Record a failed fetch, returning whether it opened the breaker
+        """
+        with self._lock:
+            failures = self._failures[host] = self._failures.get(host, 0) + 1
+            if not self.threshold or failures < self.threshold:
+                return False
+            tripped = host not in self._open_until
+            self._open_until[host] = now + self.cooldown
+            return tripped
+
+class ParseStage(object):
+    """
+    Turns fetched pages into snapshots. With ``processes`` set, link
+    extraction and checksumming run in a ``multiprocessing`` pool so that
+    parsing large pages doesn't serialize the fetch workers on the GIL;
+    otherwise pages are parsed inline. Set ``cooperative`` under the async
+    engine, so waiting on the pool yields to other greenlets.
+    """
+    def __init__(self, processes=0, extractor=None, hasher=None,
+      cooperative=False, poll_interval=0.005):
+        LOG.info('parse processes: %s' % (processes or 'inline'))
+        LOG.info('link extractor: %s' % (extractor or DEFAULT_EXTRACTOR))
+        LOG.info('snapshot hasher: %s' % (hasher or DEFAULT_HASHER))
+        # fail early on an unknown or unavailable extractor or hasher
+        get_extractor(extractor)
+        get_hasher(hasher)
+
+        self.processes = processes
+        self.extractor = extractor
+        self.hasher = hasher
+        self.cooperative = cooperative
+        self.poll_interval = poll_interval
+        self._pool = None
+        self._pool_seconds = stage('parse_pool')
+
+        if processes:
+            self._pool = multiprocessing.Pool(processes,
+                initializer=ignore_interrupts)
+
+    def stream_extractor(self, regex):
+        """
+        An extractor for a page body to be fed to as it downloads, or
+        ``None`` if pages are parsed in a pool or the configured backend
+        can't parse incrementally
+        """
+        backend = get_extractor(self.extractor)
+        if self._pool is not None or not backend.incremental:
+            return None
+        return backend(regex)
+
+    def snapshot(self, page):
+        if page.parsed:
+            # links came in with the body; the page's own snapshot is
+            # memoized, so hash it as the pool would
+            page.hasher = self.hasher
+            return page.snapshot
+
+        args = (page.markup, page.regex, self.extractor, self.hasher)
+
+        if self._pool is None:
+            links, digest = parse_markup(*args)
+        else:
+            # parse and hash times are recorded in the worker processes,
+            # out of reach; time the round trip instead
+            with self._pool_seconds.time():
+                result = self._pool.apply_async(parse_markup, args)
+
+                # get() would block the whole hub; poll instead, so other
+                # greenlets keep being scheduled
+                if self.cooperative:
+                    while not result.ready():
+                        time.sleep(self.poll_interval)
+
+                links, digest = result.get()
+
+        return PageSnapshot(page.url, links, page.regex, hasher=self.hasher,
+            digest=digest)
+
+    def shutdown(self):
+        if self._pool is not None:
+            LOG.debug('shutting down parse processes')
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+def estimate_period(history, now, default):
+    """
+    Estimate how often a page changes from ``history``, the times (newest
+    first) its recent snapshots were taken. Each snapshot after the first
+    marks a change, so ``n`` snapshots witness ``n - 1`` changes between
+    the oldest of them and ``now``. With no change seen yet, the page has
+    held still for at least that long.
+    """
+    if not history:
+        return default
+
+    oldest = time.mktime(history[-1].timetuple())
+    span = max(now - oldest, 0)
+    changes = len(history) - 1
+    if not changes:
+        return max(span, default)
+    return span / changes
+
 class Crawler(object):
     def __init__(self, period=3600, db=None, count=-1, threaded=True, max_threads=5,
-      log_level=None):
+      log_level=None, sessions=None, engine='thread', concurrency=1000,
+      parse_processes=0, extractor=None, write_batch_size=500,
+      write_interval=1.0, hosts=None, schedule='fixed', min_period=60,
+      max_period=86400, history=10, connect_timeout=10, read_timeout=30,
+      retries=2, retry_backoff=0.5, breaker=None, max_size=0,
+      content_types=None, stream_parse=False, hasher=None, exporters=()):
         self.log_level = log_level
 
         # this this is likely a long-running process, set a better log level
@@ -76,11 +429,65 @@ class Crawler(object):
 
         self.period = period
         self.count = count
+        # how often (seconds) the scheduler checks for due pages while idle
+        self.tick = 0.05
+        self.adaptive = schedule == 'adaptive'
+        self.min_period = min_period
+        self.max_period = max_period
+        self.history = history
         self.db = db or Database()
-        self.executor = Executor(self.crawl_page, threaded=threaded, max_threads=max_threads)
+        self.writer = Writer(self.db, batch_size=write_batch_size,
+            flush_interval=write_interval)
+        # (url, regex) -> validators and body digest of the last crawl,
+        # kept across rounds so unchanged pages cost no database reads.
+        # Only committed state is cached; state still waiting on the writer
+        # is kept apart, and dropped if its write fails.
+        self._page_state = {}
+        self._queued_state = {}
+        self._state_lock = threading.Lock()
+        self.counters = Counters(registry=REGISTRY)
+        self.round_stats = {}
+        # metrics exposition (unfurl.exposition.MetricsServer/MetricsFile),
+        # running for as long as the crawl
+        self.exporters = exporters
+        self._dedup_seconds = stage('dedup_query')
+        self._gauges = dict((name, REGISTRY.gauge('unfurl_%s' % name, help)) \
+            for name, help in [
+              ('in_flight', 'Page crawls in progress'),
+              ('scheduled', 'Pages waiting for their next crawl'),
+              ('host_queued', 'Due pages waiting on host limits'),
+            ])
+        self.sessions = sessions or SessionPool()
+        self.hosts = hosts if hosts is not None else HostLimits()
+        self.breaker = breaker or CircuitBreaker()
+        self.fetch_options = {
+          'timeout': (connect_timeout, read_timeout),
+          'retries': retries,
+          'backoff': retry_backoff,
+          'counters': self.counters,
+          'max_size': max_size,
+          'content_types': content_types,
+        }
+        LOG.info('maximum response size: %s' % (max_size or 'unlimited'))
+        LOG.info('accepted content types: %s' % \
+            (', '.join(content_types or []) or 'any'))
+        self.stream_parse = stream_parse
+        # fork the parse pool before any crawl threads/greenlets exist
+        self.parser = ParseStage(processes=parse_processes, extractor=extractor,
+            hasher=hasher, cooperative=engine == 'async')
+        if engine == 'async':
+            self.executor = AsyncExecutor(self.crawl_page,
+                concurrency=concurrency)
+            self.sessions.reserve(concurrency)
+        else:
+            self.executor = Executor(self.crawl_page, threaded=threaded,
+                max_threads=max_threads)
 
         LOG.info('crawler period: %d' % self.period)
         LOG.info('crawler count: %d' % self.count)
+        if self.adaptive:
+            LOG.info('adaptive schedule between %d and %d seconds' % \
+                (self.min_period, self.max_period))
         LOG.info('crawler db: %s' % self.db.location)
 
     def _setup_logging(self):
@@ -90,47 +497,234 @@ class Crawler(object):
             if LOG.level == logging.NOTSET or LOG.level > logging.INFO:
                 LOG.setLevel(logging.INFO)
 
+    def _get_state(self, page):
+        key = (page.url, page.regex)
+        with self._state_lock:
+            state = self._queued_state.get(key)
+            if state is None:
+                state = self._page_state.get(key)
+        if state is None:
+            state = self._page_state[key] = \
+                self.db.get_validators(page.url, page.regex)
+        return state
+
+    def _set_state(self, page, state, snapshot=None, created=None):
+        """
+        Queue ``state`` (and ``snapshot``, taken at ``created``, if the
+        crawl found a new one) to be stored together, caching ``state`` once
+        it's committed
+        """
+        if snapshot is None and state == self._get_state(page):
+            return
+        key = (page.url, page.regex)
+        with self._state_lock:
+            self._queued_state[key] = state
+        self.writer.record_crawl(page.url, page.regex, snapshot,
+            created=created, callback=lambda error: self._state_written(key, state, error),
+            **state)
+
+    def _state_written(self, key, state, error):
+        with self._state_lock:
+            if self._queued_state.get(key) is state:
+                del self._queued_state[key]
+            if error is None:
+                self._page_state[key] = state
+                return
+        LOG.error('could not store the crawl of %s: %s' % (key[0], error))
+        self.counters.incr('write_failed')
+
     def crawl_page(self, page):
+        try:
+            self._crawl_page(page)
+        finally:
+            # the page lives as long as the crawl; its body mustn't
+            page.release()
+
+    def _crawl_page(self, page):
         LOG.debug('crawling %s' % page.url)
-        page.load()
+        host = page.host
+        if not self.breaker.allow(host, time.time()):
+            LOG.debug('circuit breaker open for %s, skipping' % host)
+            self.counters.incr('breaker_skipped')
+            return
 
-        if not page.loaded:
+        state = self._get_state(page)
+        # snapshots are dated by when the page was fetched, not when the
+        # writer gets round to them
+        fetched = datetime.datetime.now()
+        extractor = None
+        if self.stream_parse:
+            extractor = self.parser.stream_extractor(page.regex)
+        page.load(session=self.sessions.get(), etag=state.get('etag'),
+            last_modified=state.get('last_modified'), extractor=extractor,
+            **self.fetch_options)
+        self.counters.incr('fetched')
+
+        if page.failed:
             LOG.error('could not load page, skipping')
+            self.counters.incr('failed')
+            if self.breaker.failure(host, time.time()):
+                LOG.warning('too many failures from %s, pausing it for %d '
+                    'seconds' % (host, self.breaker.cooldown))
+                self.counters.incr('breaker_tripped')
+            return
+
+        self.breaker.success(host)
+
+        if page.rejected:
+            self.counters.incr('rejected')
+            return
+
+        if not page.modified:
+            LOG.debug('page not modified since last crawl, skipping')
+            self.counters.incr('not_modified')
+            return
+
+        digest = page.digest
+        if digest == state.get('digest'):
+            LOG.debug('response body unchanged since last crawl, skipping')
+            self.counters.incr('unchanged_body')
             return
        
-        if not Snapshot.exact(page.snapshot): 
+        snapshot = self.parser.snapshot(page)
+        self.counters.incr('parsed')
+
+        with self._dedup_seconds.time():
+            exists = Snapshot.exact(snapshot)
+
+        if not exists:
             LOG.debug("didn't find snapshot in db, adding new entry")
-            self.db.add_snapshot(page.snapshot)        
+            self.counters.incr('new_snapshots')
         else:
             LOG.debug("identical snapshot already exists in database, skipping")
+            snapshot = None
+
+        self._set_state(page, {
+          'etag': page.etag,
+          'last_modified': page.last_modified,
+          'digest': digest,
+        }, snapshot, fetched)
+
+    def period_for(self, page):
+        """
+        Seconds between crawls of ``page``: its own period if configured,
+        otherwise (with the adaptive schedule) the rate its links have been
+        changing at, bounded by ``min_period`` and ``max_period``, or else
+        the crawler's period
+        """
+        if page.period is not None:
+            return page.period
+
+        if not self.adaptive:
+            return self.period
+
+        history = Snapshot.history(page.url, page.regex, self.history)
+        period = estimate_period(history, time.time(), self.period)
+        period = min(max(period, self.min_period), self.max_period)
+        LOG.debug('adaptive period for %s: %.0f seconds' % (page.url, period))
+        return period
+
+    def _dispatch(self, host, due, page, crawls):
+        with self._lock:
+            self._in_flight += 1
+        self.executor.submit(page,
+            callback=lambda page: self._finished(host, page, due, crawls + 1))
+
+    def _finished(self, host, page, due, crawls):
+        try:
+            if self.count < 0 or crawls < self.count:
+                try:
+                    period = self.period_for(page)
+                except Exception, e:
+                    LOG.exception('could not work out when %s is next due, '
+                        'using the default period' % page.url)
+                    period = self.period
+                # deadline-driven: the next crawl is due one period after
+                # this one was due, not after it finished, so slow pages
+                # don't drift
+                next_due = max(due + period, time.time())
+                self.schedule.add(next_due, (page, crawls))
+        finally:
+            # whatever happens, the crawl loop mustn't wait on this page
+            self.hosts.release(host)
+            with self._lock:
+                self._in_flight -= 1
+
+    def _report(self, interval):
+        self.round_stats = self.counters.reset()
+        LOG.info('last %.0f seconds: %s' % (interval, ', '.join('%s=%d' % i \
+            for i in sorted(self.round_stats.items())) or 'idle'))
 
     def crawl(self, pages):
+        """
+        Crawl each page every ``period_for(page)`` seconds, ``count`` times
+        (or forever if ``count`` is negative). Pages are kept in a schedule
+        ordered by when they're next due and handed to long-lived workers
+        as they come due, so every page keeps its own schedule regardless
+        of how long the others take.
+        """
         LOG.info('starting crawl loop over %d page(s)' % len(pages))
-        elapsed = 0
 
         if self.count == 0:
             return
 
-        while True:
-            start = time.time()
-            try:
-                self.executor.work_on(pages)
-            except Exception, e:
-                LOG.exception('caught unhandled exception')
-                self.executor.shutdown()
-    
-            elapsed += 1
+        self.schedule = Schedule()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+        start = last_report = time.time()
+        for page in pages:
+            self.schedule.add(start, (page, 0))
+
+        self.writer.start()
+        self.executor.start()
+        for exporter in self.exporters:
+            exporter.start()
+
+        try:
+            while len(self.schedule) or len(self.hosts) or self._in_flight:
+                now = time.time()
+
+                # queue everything that's due by host...
+                while True:
+                    job = self.schedule.pop_due(now)
+                    if job is None:
+                        break
+                    due, (page, crawls) = job
+                    self.hosts.add(page.host, (due, page, crawls))
+
+                # ...and start as much as host limits and workers allow
+                while self._in_flight < self.executor.capacity:
+                    job = self.hosts.take(now)
+                    if job is None:
+                        break
+                    host, (due, page, crawls) = job
+                    self._dispatch(host, due, page, crawls)
 
-            if elapsed == self.count:
-                break
+                self._gauges['in_flight'].set(self._in_flight)
+                self._gauges['scheduled'].set(len(self.schedule))
+                self._gauges['host_queued'].set(len(self.hosts))
 
-            LOG.info('round %d took %.3f seconds total' % \
-                (elapsed, (time.time() - start)))
-            
-            self.sleep()
+                if self.period and now - last_report >= self.period:
+                    self._report(now - last_report)
+                    last_report = now
 
-        self.executor.shutdown()
+                # nothing more can start until a worker frees up, a host's
+                # delay passes or the next page comes due. time.sleep (not
+                # an Event/Condition wait) keeps the async engine's hub
+                # running.
+                wait = self.tick
+                next_due = self.schedule.next_due()
+                if next_due is not None:
+                    wait = min(wait, max(next_due - time.time(), 0))
+                time.sleep(wait)
+        finally:
+            self.executor.shutdown()
+            self.parser.shutdown()
+            self.writer.shutdown()
+            self.sessions.close()
+            for exporter in self.exporters:
+                exporter.stop()
 
-    def sleep(self):
-        LOG.info('sleeping for %d seconds' % self.period)
-        time.sleep(self.period)
+        self._report(time.time() - last_report)
+        LOG.info('crawl took %.3f seconds total' % (time.time() - start))
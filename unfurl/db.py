@@ -1,51 +1,245 @@
 from peewee import (
   SqliteDatabase, Model, CharField, IntegerField, DateTimeField,
-  BlobField,
+  BlobField, fn,
 )
-from unfurl.config import CONFIG
+from unfurl.config import CONFIG, AUTO_VACUUM_MODES
+from unfurl.diff import format_diff
+from unfurl.hashing import digest_links, HasherUnavailable, DEFAULT_HASHER
+from unfurl.metrics import REGISTRY, stage
 from unfurl.page import PageSnapshot
+from unfurl.util import chunked, timeit
+import binascii
 import datetime
-import difflib
-import sqlite3
+import logging
+import Queue
 import sys
+import threading
+import time
+import zlib
 try:
     import json
 except ImportError:
     import simplejson as json
 
+LOG = logging.getLogger(__name__)
 
-_database = SqliteDatabase(None, threadlocals=True)
+class _SqliteDatabase(SqliteDatabase):
+    """
+    Applies ``pragmas`` to every new connection. Connections are
+    thread-local, so each thread gets its own.
+    """
+    pragmas = ()
+
+    def _connect(self, database, **kwargs):
+        conn = super(_SqliteDatabase, self)._connect(database, **kwargs)
+        for key, value in self.pragmas:
+            conn.execute('PRAGMA %s = %s' % (key, value))
+        return conn
+
+_database = _SqliteDatabase(None, threadlocals=True)
 
 class BaseModel(Model):
     class Meta:
         database = _database
 
+# How Snapshot.data is stored:
+#
+#   raw:      the NUL-joined link list (rows from before encodings existed
+#             have no encoding and are raw)
+#   zlib:     the NUL-joined, utf-8 encoded link list, zlib-compressed
+#   interned: link strings live once in the link table; data holds the
+#             sorted link ids, gap- and varint-encoded, zlib-compressed
+RAW, ZLIB, INTERNED = 'raw', 'zlib', 'interned'
+
+# sqlite allows at most 999 bound parameters per statement
+MAX_VARIABLES = 500
+
+def _unicode(href):
+    if isinstance(href, unicode):
+        return href
+    return href.decode('utf-8')
+
+def _utf8_blob(links):
+    # sqlite blobs are bytes, so unicode links are stored utf-8 encoded
+    return '\x00'.join(_unicode(i).encode('utf-8') for i in links)
+
+def _pack_ids(ids):
+    data = bytearray()
+    previous = 0
+    for i in sorted(ids):
+        gap, previous = i - previous, i
+        while gap > 0x7f:
+            data.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        data.append(gap)
+    return zlib.compress(str(data))
+
+def _unpack_ids(data):
+    ids = []
+    previous = gap = shift = 0
+    for byte in bytearray(zlib.decompress(data)):
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += gap
+            ids.append(previous)
+            gap = shift = 0
+    return ids
+
+class Link(BaseModel):
+    """
+    An interned link string, shared by every snapshot containing it
+    """
+    href = CharField(unique=True)
+
+    @classmethod
+    def _lookup(cls, hrefs, ids):
+        for chunk in chunked(hrefs, MAX_VARIABLES):
+            for link in cls.select().where(cls.href << chunk):
+                ids[link.href] = link.id
+
+    @classmethod
+    def intern(cls, hrefs):
+        """
+        Return the ids of ``hrefs``, adding any that aren't stored yet
+        """
+        hrefs = [ _unicode(i) for i in hrefs ]
+        ids = {}
+        cls._lookup(hrefs, ids)
+
+        missing = [ i for i in set(hrefs) if i not in ids ]
+        for chunk in chunked(missing, MAX_VARIABLES):
+            cls.insert_many([ {'href': i} for i in chunk ]).execute()
+        cls._lookup(missing, ids)
+
+        return [ ids[i] for i in hrefs ]
+
+    @classmethod
+    def resolve(cls, ids):
+        """
+        Return the link strings for ``ids``
+        """
+        hrefs = []
+        for chunk in chunked(ids, MAX_VARIABLES):
+            hrefs.extend(i.href for i in \
+                cls.select(cls.href).where(cls.id << chunk))
+        return hrefs
+
 class Snapshot(BaseModel):
     url = CharField()
     created = DateTimeField(default=datetime.datetime.now)
     data = BlobField()
-    checksum = CharField()
+    # rows from before hashers were recorded have a hex SHA-512 checksum
+    # and no hasher or digest; newer rows leave the checksum empty
+    checksum = CharField(default='')
     regex = CharField()
+    encoding = CharField(null=True)
+    hasher = CharField(null=True)
+    digest = BlobField(null=True)
+
+    @classmethod
+    def encode(cls, snapshot, encoding=RAW):
+        """
+        Return the ``data`` value storing ``snapshot``'s links in
+        ``encoding``
+        """
+        if encoding == RAW:
+            return _utf8_blob(snapshot.links)
+        if encoding == ZLIB:
+            return zlib.compress(_utf8_blob(snapshot.links))
+        if encoding == INTERNED:
+            return _pack_ids(Link.intern(snapshot.links))
+        raise ValueError('unknown snapshot encoding "%s"' % encoding)
+
+    @property
+    def links(self):
+        """
+        The sorted link list, decoded from whichever encoding it's stored in
+        """
+        encoding = self.encoding or RAW
+        if encoding == RAW:
+            links = PageSnapshot.unblob(self.data) if self.data else []
+        elif encoding == ZLIB:
+            data = zlib.decompress(self.data)
+            links = data.split('\x00') if data else []
+        elif encoding == INTERNED:
+            links = [ i.encode('utf-8') for i in \
+                Link.resolve(_unpack_ids(self.data)) ]
+        else:
+            raise ValueError('unknown snapshot encoding "%s"' % encoding)
+        links.sort()
+        return links
 
     @classmethod
     def last(cls, url=None, offset=None):
         query = cls.filter_attr(url=url, offset=offset)
         return query.first()
 
+    @property
+    def stored_digest(self):
+        """
+        The binary digest of this row's links, and the hasher behind it
+        """
+        if self.hasher is None:
+            return binascii.unhexlify(self.checksum), DEFAULT_HASHER
+        return str(self.digest), self.hasher
+
     def object(self):
+        digest, hasher = self.stored_digest
         return PageSnapshot(
           url=self.url, 
           regex=self.regex,
-          links=PageSnapshot.unblob(self.data),
+          links=self.links,
+          hasher=hasher,
+          digest=digest,
+          encoding=CONFIG.get('global', 'checksum_encoding'),
         )
 
+    def matches(self, links):
+        """
+        Whether the sorted list ``links`` is what this row holds, going by
+        a digest made with the row's own hasher
+        """
+        digest, hasher = self.stored_digest
+        try:
+            return digest_links(links, hasher) == digest
+        except HasherUnavailable:
+            return False
+
     @classmethod
     def exact(cls, snapshot):
-        return cls.select().where(
+        query = cls.select().where(
           (cls.url == snapshot.url) & 
-          (cls.checksum == snapshot.checksum) &
           (cls.regex == snapshot.regex)
+        )
+        match = query.where(
+          (cls.hasher == snapshot.hasher) &
+          (cls.digest == buffer(snapshot.digest))
         ).first()
+        if match is not None:
+            return match
+
+        # rows hashed differently (or before hashers were recorded) can
+        # only be compared by rehashing; checking the newest one carries
+        # deduplication across a change of hasher
+        last = query.order_by(cls.created.desc()).first()
+        if last is not None and last.hasher != snapshot.hasher and \
+          last.matches(snapshot.links):
+            return last
+        return None
+
+    @classmethod
+    def history(cls, url, regex, limit=10):
+        """
+        Return when the ``limit`` most recent snapshots of ``url`` (each
+        one a change in its links) were taken, newest first
+        """
+        query = cls.select(cls.created).where(
+          (cls.url == url) &
+          (cls.regex == regex)
+        ).order_by(cls.created.desc()).limit(limit)
+        return [ i.created for i in query ]
 
     @classmethod
     def last_two(cls, url, old_offset=1, new_offset=0):
@@ -61,7 +255,7 @@ class Snapshot(BaseModel):
         return old_snap, new_snap
 
     @classmethod
-    def diff(cls, url, old_offset=1, new_offset=0):
+    def diff(cls, url, old_offset=1, new_offset=0, format='unified'):
         old_snap, new_snap = Snapshot.last_two(
             url, old_offset=old_offset, new_offset=new_offset)
 
@@ -77,10 +271,84 @@ class Snapshot(BaseModel):
             old_links = old.links
             from_date = old_snap.created
 
-        items = list(difflib.unified_diff(old_links, new_links, lineterm='',
-            fromfiledate=from_date, tofiledate=to_date, 
-            tofile=new.url, fromfile=new.url))  
-        return '\n'.join(items) + '\n'
+        return format_diff(old_links, new_links, format=format, url=new.url,
+            from_date=from_date, to_date=to_date)
+
+    @classmethod
+    def expired(cls, retention, url=None):
+        """
+        Yield the ids of snapshots ``retention`` doesn't keep. The rows are
+        read in (url, created) order, a page at a time, so only the newest
+        snapshot of each period seen so far is held in memory.
+        """
+        query = cls.select(cls.id, cls.url, cls.regex, cls.created).where(
+          cls.created < retention.keep_all)
+        if url:
+            query = query.where(cls.url == url)
+        query = query.order_by(cls.url, cls.created, cls.id)
+
+        current = None
+        newest = {}
+        for id, url, regex, created in query.tuples().iterator():
+            if url != current:
+                current = url
+                newest = {}
+            key = (regex, retention.bucket(created))
+            if key in newest:
+                yield newest[key]
+            newest[key] = id
+
+    @classmethod
+    def between(cls, since=None, until=None, urls=None, match=None):
+        """
+        Select the snapshots taken between ``since`` and ``until``, of
+        ``urls`` or of pages matching the ``GLOB`` pattern ``match``
+        """
+        query = cls.select()
+        if since:
+            query = query.where(cls.created >= since)
+        if until:
+            query = query.where(cls.created < until)
+        if urls:
+            query = query.where(cls.url << list(urls))
+        if match:
+            query = query.where(fn.GLOB(match, cls.url))
+        return query
+
+    @classmethod
+    def changes(cls, since=None, until=None, urls=None, match=None):
+        """
+        Yield ``(previous, snapshot)`` for every snapshot taken between
+        ``since`` and ``until``, where ``previous`` is the snapshot of the
+        same page (url and regex) before it, or ``None`` for a page's first.
+        Pages can be limited to ``urls`` or to those matching the ``GLOB``
+        pattern ``match``.
+
+        Snapshots in the range come from one scan in (url, created) order;
+        the snapshot each page had before ``since`` costs one more query.
+        """
+        query = cls.between(since=since, until=until, urls=urls,
+            match=match).order_by(cls.url, cls.created, cls.id)
+
+        current = None
+        previous = {}
+        for snapshot in query.iterator():
+            if snapshot.url != current:
+                current = snapshot.url
+                previous = {}
+            if snapshot.regex not in previous:
+                previous[snapshot.regex] = since and cls._before(snapshot,
+                    since)
+            yield previous[snapshot.regex], snapshot
+            previous[snapshot.regex] = snapshot
+
+    @classmethod
+    def _before(cls, snapshot, time):
+        return cls.select().where(
+          (cls.url == snapshot.url) &
+          (cls.regex == snapshot.regex) &
+          (cls.created < time)
+        ).order_by(cls.created.desc()).first()
 
     @classmethod
     def filter_attr(cls, url=None, offset=None):
@@ -109,12 +377,110 @@ class Snapshot(BaseModel):
 
         return True
          
+class Retention(object):
+    """
+    Which snapshots to keep: all of those from the last ``keep_all_days``,
+    then the newest of each day up to ``keep_daily_days`` old and the
+    newest of each week before that.
+    """
+    def __init__(self, keep_all_days=30, keep_daily_days=365, now=None):
+        now = now or datetime.datetime.now()
+        self.keep_all = now - datetime.timedelta(days=keep_all_days)
+        self.keep_daily = now - datetime.timedelta(days=keep_daily_days)
+
+    def bucket(self, created):
+        """
+        The period a snapshot from ``created`` is thinned to one of, or
+        ``None`` if it's recent enough to keep regardless
+        """
+        if created >= self.keep_all:
+            return None
+        if created >= self.keep_daily:
+            return created.date()
+        return created.isocalendar()[:2]
+
+class Validator(BaseModel):
+    """
+    HTTP cache validators (``ETag``/``Last-Modified``) and a digest of the
+    raw response body from the last time a URL was fetched and its snapshot
+    recorded.
+    """
+    url = CharField(unique=True)
+    regex = CharField()
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    digest = CharField(null=True)
+
+    @classmethod
+    def lookup(cls, url, regex):
+        return cls.select().where(
+          (cls.url == url) &
+          (cls.regex == regex)
+        ).first()
+
 class NoSuchRecord(RuntimeError): pass
 
+def _index(db, name, table, columns):
+    db.execute_sql('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % \
+        (name, table, ', '.join(columns)))
+
+def _add_column(db, table, column, definition):
+    columns = [ i[1] for i in \
+        db.execute_sql('PRAGMA table_info(%s)' % table).fetchall() ]
+    if column not in columns:
+        db.execute_sql('ALTER TABLE %s ADD COLUMN %s %s' % \
+            (table, column, definition))
+
+def _add_snapshot_indexes(db):
+    # Snapshot.exact (crawl-time dedup)
+    _index(db, 'snapshot_url_regex_checksum', 'snapshot',
+        ['url', 'regex', 'checksum'])
+    # Snapshot.filter_attr (latest snapshots of a url, for diff/dump)
+    _index(db, 'snapshot_url_created', 'snapshot', ['url', 'created'])
+
+# Schema migrations, applied in order. Migration ``n`` upgrades a database
+# at schema version ``n`` to version ``n + 1``; the version is kept in
+# sqlite's ``user_version`` pragma. Tables are created at their current
+# definition before migrating, so migrations must tolerate already being
+# applied.
+def _add_snapshot_encoding(db):
+    _add_column(db, 'snapshot', 'encoding', 'VARCHAR(255)')
+
+def _add_validator_digest(db):
+    _add_column(db, 'validator', 'digest', 'VARCHAR(255)')
+
+def _add_snapshot_digest(db):
+    _add_column(db, 'snapshot', 'hasher', 'VARCHAR(255)')
+    _add_column(db, 'snapshot', 'digest', 'BLOB')
+    # Snapshot.exact, for rows with a recorded hasher
+    _index(db, 'snapshot_url_regex_hasher_digest', 'snapshot',
+        ['url', 'regex', 'hasher', 'digest'])
+
+def _drop_snapshot_checksum_index(db):
+    # Snapshot.exact looks rows up by digest now, and new rows all have the
+    # same empty checksum, so the index only slowed inserts down
+    db.execute_sql('DROP INDEX IF EXISTS snapshot_url_regex_checksum')
+
+MIGRATIONS = [
+  _add_snapshot_indexes,
+  _add_snapshot_encoding,
+  _add_validator_digest,
+  _add_snapshot_digest,
+  _drop_snapshot_checksum_index,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
 class Database(object):
-    def __init__(self, db=None):
+    def __init__(self, db=None, pragmas=None, storage=None):
         self._location = db or CONFIG.get('global', 'database')
+        self.storage = storage or CONFIG.get('global', 'storage')
         self._cursor = _database
+        if pragmas is None:
+            # auto_vacuum first: it only takes on a new database if set
+            # before any tables exist
+            pragmas = [ (i, CONFIG.get('global', i)) for i in \
+                ('auto_vacuum', 'journal_mode', 'synchronous', 'cache_size') ]
+        self._cursor.pragmas = pragmas
         self.initialize()
 
     @property
@@ -122,22 +488,296 @@ class Database(object):
         return self._cursor.database
 
     def initialize(self):
+        if self._cursor.database not in (None, self._location) and \
+          not self._cursor.is_closed():
+            # don't keep talking to a previously configured database
+            self._cursor.close()
         self._cursor.init(self._location)
-        try:
-            self.create_tables()
-        except sqlite3.OperationalError, e:
-            if 'already exists' not in e.args[0]:
-                raise e
+        self.create_tables()
+        self.migrate()
 
     def create_tables(self):
-        for table in [Snapshot]:
-            self._cursor.create_table(table)
+        for table in [Snapshot, Validator, Link]:
+            self._cursor.create_table(table, safe=True)
 
-    @classmethod
-    def add_snapshot(cls, snapshot):
+    @property
+    def schema_version(self):
+        return self._cursor.execute_sql('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self):
+        """
+        Bring the database schema up to ``SCHEMA_VERSION`` in place
+        """
+        version = self.schema_version
+        if version > SCHEMA_VERSION:
+            raise RuntimeError('database schema version %d is newer than '
+                'this version of unfurl supports (%d)' % \
+                (version, SCHEMA_VERSION))
+
+        for number in range(version, SCHEMA_VERSION):
+            LOG.info('migrating database schema to version %d' % (number + 1))
+            with self._cursor.transaction():
+                MIGRATIONS[number](self._cursor)
+                self._cursor.execute_sql('PRAGMA user_version = %d' % \
+                    (number + 1))
+
+    @timeit('snapshot insert', stage('insert'))
+    def add_snapshot(self, snapshot, created=None):
         return Snapshot(
           url=snapshot.url,
-          data=snapshot.blob,
-          checksum=snapshot.checksum,
+          created=created or datetime.datetime.now(),
+          data=Snapshot.encode(snapshot, self.storage),
           regex = snapshot.regex,
+          encoding=self.storage,
+          hasher=snapshot.hasher,
+          digest=snapshot.digest,
         ).save()
+
+    @classmethod
+    def get_validators(cls, url, regex):
+        """
+        Return the validators and body digest stored for ``url``.
+        Validators recorded under a different regex are ignored, since the
+        stored snapshot wouldn't apply.
+        """
+        validator = Validator.lookup(url, regex)
+        if not validator:
+            return {}
+        return {
+          'etag': validator.etag,
+          'last_modified': validator.last_modified,
+          'digest': validator.digest,
+        }
+
+    @classmethod
+    def set_validators(cls, url, regex, etag=None, last_modified=None,
+      digest=None):
+        Validator.insert(
+          url=url,
+          regex=regex,
+          etag=etag,
+          last_modified=last_modified,
+          digest=digest,
+        ).upsert().execute()
+
+    def record_crawl(self, url, regex, snapshot=None, etag=None,
+      last_modified=None, digest=None, created=None):
+        """
+        Store what a crawl of ``url`` (at ``created``, or now) found: its
+        new ``snapshot`` (if any) and its validators and body digest. Run in
+        one transaction, they're committed or lost together.
+        """
+        if snapshot is not None:
+            self.add_snapshot(snapshot, created)
+        self.set_validators(url, regex, etag, last_modified, digest)
+
+    def compact(self, retention, url=None, batch_size=1000, dry_run=False):
+        """
+        Delete the snapshots (of ``url``, or of every page) that
+        ``retention`` doesn't keep, ``batch_size`` per transaction so a
+        running crawl is never locked out for long. Returns how many there
+        were.
+        """
+        # read them all before deleting any, rather than write under an open
+        # read cursor
+        expired = list(Snapshot.expired(retention, url=url))
+        if dry_run:
+            return len(expired)
+
+        for batch in chunked(expired, batch_size):
+            with self.transaction():
+                for ids in chunked(batch, MAX_VARIABLES):
+                    Snapshot.delete().where(Snapshot.id << ids).execute()
+            LOG.debug('deleted %d snapshots' % len(batch))
+        return len(expired)
+
+    def collect_links(self, dry_run=False):
+        """
+        Delete interned links no snapshot refers to any more. Returns how
+        many there were.
+        """
+        # one transaction, so links interned by a concurrent crawl after
+        # the scan can't be mistaken for unused ones
+        with self.transaction():
+            used = set()
+            query = Snapshot.select(Snapshot.data).where(
+              Snapshot.encoding == INTERNED)
+            for (data,) in query.tuples().iterator():
+                used.update(_unpack_ids(data))
+
+            unused = [ i for (i,) in Link.select(Link.id).tuples() \
+                if i not in used ]
+            if not dry_run:
+                for ids in chunked(unused, MAX_VARIABLES):
+                    Link.delete().where(Link.id << ids).execute()
+        return len(unused)
+
+    def vacuum(self, mode='incremental'):
+        """
+        Give the space freed by deletes back to the filesystem. A database
+        created before ``mode`` was configured needs a full ``VACUUM``
+        once to switch over; after that, an incremental vacuum is cheap.
+        Returns the number of pages freed.
+        """
+        pages = self._pragma('page_count')
+        current = AUTO_VACUUM_MODES[self._pragma('auto_vacuum')]
+        if current != mode.lower():
+            LOG.info('switching database to %s auto-vacuum (one-off full '
+                'vacuum)' % mode)
+            self._cursor.execute_sql('PRAGMA auto_vacuum = %s' % mode)
+            self._cursor.execute_sql('VACUUM')
+        elif current == 'incremental':
+            # the pragma does its work as its result rows are stepped through
+            self._cursor.execute_sql('PRAGMA incremental_vacuum').fetchall()
+        return pages - self._pragma('page_count')
+
+    def _pragma(self, name):
+        return self._cursor.execute_sql('PRAGMA %s' % name).fetchone()[0]
+
+    def transaction(self):
+        return self._cursor.transaction()
+
+class Writer(object):
+    """
+    The single writer stage of a crawl. Workers queue their writes here and
+    a dedicated thread commits them in batches, one transaction per
+    ``batch_size`` writes or ``flush_interval`` seconds (whichever comes
+    first), so workers never contend for sqlite's write lock. If a batch
+    fails, its writes are retried one transaction each, so one bad write
+    doesn't lose the rest. A write's ``callback`` (if given) is called from
+    the writer thread once it's committed, with ``None``, or with the
+    exception if it failed. Snapshots are dated when they're queued, not
+    when they're committed.
+    """
+    def __init__(self, db, batch_size=500, flush_interval=1.0):
+        LOG.info('writer batch size: %s' % batch_size)
+        LOG.info('writer flush interval: %s' % flush_interval)
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = Queue.Queue()
+        self._queued = REGISTRY.gauge('unfurl_writer_queue',
+            'Writes waiting for the database writer')
+        self._commit_seconds = stage('commit')
+        self._flushing = threading.Event()
+        self._shutdown = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._shutdown.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_snapshot(self, snapshot, created=None, callback=None):
+        self._queue.put((self.db.add_snapshot,
+            (snapshot, created or datetime.datetime.now()), callback))
+
+    def set_validators(self, url, regex, etag=None, last_modified=None,
+      digest=None, callback=None):
+        self._queue.put((self.db.set_validators,
+            (url, regex, etag, last_modified, digest), callback))
+
+    def record_crawl(self, url, regex, snapshot=None, etag=None,
+      last_modified=None, digest=None, created=None, callback=None):
+        self._queue.put((self.db.record_crawl,
+            (url, regex, snapshot, etag, last_modified, digest,
+             created or datetime.datetime.now()), callback))
+
+    def flush(self):
+        """
+        Block until everything queued so far has been committed
+        """
+        if self._thread is None:
+            return
+        self._flushing.set()
+        # wake the writer if it's waiting for a batch to fill up
+        self._queue.put(None)
+        self._queue.join()
+        self._flushing.clear()
+
+    def shutdown(self):
+        LOG.debug('flushing and stopping the writer')
+        self.flush()
+        self._shutdown.set()
+        if self._thread is not None:
+            # wake the writer thread up
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._shutdown.is_set():
+            try:
+                batch = [ self._queue.get(timeout=0.5) ]
+            except Queue.Empty:
+                continue
+
+            # woken up by flush() or shutdown() with nothing to write
+            if batch[0] is None:
+                self._queue.task_done()
+                continue
+
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self._flushing.is_set():
+                    timeout = 0
+                else:
+                    timeout = deadline - time.time()
+                try:
+                    if timeout <= 0:
+                        write = self._queue.get_nowait()
+                    else:
+                        write = self._queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if write is None:
+                    # woken up by flush(): commit what there is
+                    self._queue.task_done()
+                    break
+                batch.append(write)
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        LOG.debug('committing %d write(s)' % len(batch))
+        self._queued.set(self._queue.qsize())
+        try:
+            with self._commit_seconds.time():
+                try:
+                    with self.db.transaction():
+                        for method, args, callback in batch:
+                            method(*args)
+                    errors = [ None ] * len(batch)
+                except Exception, e:
+                    LOG.warning('failed to commit %d write(s) (%s), retrying '
+                        'them one at a time' % (len(batch), e))
+                    errors = [ self._commit_one(method, args) \
+                        for method, args, callback in batch ]
+
+            for (method, args, callback), error in zip(batch, errors):
+                if callback is None:
+                    continue
+                try:
+                    callback(error)
+                except Exception:
+                    LOG.exception('write callback failed')
+        finally:
+            for i in batch:
+                self._queue.task_done()
+
+    def _commit_one(self, method, args):
+        """
+        Commit one write in its own transaction, returning the exception
+        it raised (or ``None``)
+        """
+        try:
+            with self.db.transaction():
+                method(*args)
+        except Exception, e:
+            LOG.error('failed to commit a write: %s' % e)
+            return e
+        return None
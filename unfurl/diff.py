@@ -0,0 +1,153 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+FORMATS = ('unified', 'compact', 'json')
+
+def opcodes(old, new):
+    """
+    Yield ``difflib.SequenceMatcher.get_opcodes``-style ``(tag, i1, i2, j1,
+    j2)`` tuples turning the sorted list ``old`` into the sorted list
+    ``new``. Links the two share appear in the same order in both, so one
+    merge pass lines them up, where difflib's general matching can go
+    quadratic.
+    """
+    i = j = 0
+    old_len, new_len = len(old), len(new)
+    while i < old_len or j < new_len:
+        # a run of shared links
+        i1, j1 = i, j
+        while i < old_len and j < new_len and old[i] == new[j]:
+            i += 1
+            j += 1
+        if i > i1:
+            yield ('equal', i1, i, j1, j)
+
+        # a run of changes, up to the next shared link
+        i1, j1 = i, j
+        while i < old_len and j < new_len and old[i] != new[j]:
+            if old[i] < new[j]:
+                i += 1
+            else:
+                j += 1
+        if i == old_len or j == new_len:
+            i, j = old_len, new_len
+
+        if i > i1 and j > j1:
+            yield ('replace', i1, i, j1, j)
+        elif i > i1:
+            yield ('delete', i1, i, j1, j)
+        elif j > j1:
+            yield ('insert', i1, i, j1, j)
+
+def grouped_opcodes(codes, n=3):
+    """
+    Group ``codes`` into hunks with up to ``n`` lines of context, as
+    ``difflib.SequenceMatcher.get_grouped_opcodes`` does
+    """
+    codes = list(codes) or [('equal', 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # split hunks at long unchanged stretches
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def _unified_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '%d' % beginning
+    if not length:
+        beginning -= 1
+    return '%d,%d' % (beginning, length)
+
+def unified_diff(old, new, fromfile='', tofile='', fromfiledate='',
+  tofiledate='', n=3, lineterm='\n'):
+    """
+    Yield the lines of a unified diff between the sorted lists ``old`` and
+    ``new``; a drop-in for ``difflib.unified_diff``
+    """
+    started = False
+    for group in grouped_opcodes(opcodes(old, new), n):
+        if not started:
+            started = True
+            fromdate = '\t%s' % fromfiledate if fromfiledate else ''
+            todate = '\t%s' % tofiledate if tofiledate else ''
+            yield '--- %s%s%s' % (fromfile, fromdate, lineterm)
+            yield '+++ %s%s%s' % (tofile, todate, lineterm)
+
+        first, last = group[0], group[-1]
+        yield '@@ -%s +%s @@%s' % (_unified_range(first[1], last[2]),
+            _unified_range(first[3], last[4]), lineterm)
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in old[i1:i2]:
+                    yield ' ' + line
+                continue
+            for line in old[i1:i2]:
+                yield '-' + line
+            for line in new[j1:j2]:
+                yield '+' + line
+
+def changes(old, new):
+    """
+    Return the ``(removed, added)`` links between the sorted lists ``old``
+    and ``new``, each sorted
+    """
+    removed, added = [], []
+    for tag, i1, i2, j1, j2 in opcodes(old, new):
+        if tag != 'equal':
+            removed.extend(old[i1:i2])
+            added.extend(new[j1:j2])
+    return removed, added
+
+def compact_diff(old, new):
+    """
+    Yield a ``-link`` line for each removed link and a ``+link`` line for
+    each added one
+    """
+    removed, added = changes(old, new)
+    for line in removed:
+        yield '-' + line
+    for line in added:
+        yield '+' + line
+
+def format_diff(old, new, format='unified', url=None, from_date=None,
+  to_date=None, indent=2):
+    """
+    Render the diff between the sorted lists ``old`` and ``new`` (the
+    links of ``url`` at ``from_date`` and ``to_date``) in ``format``. JSON
+    is pretty-printed with ``indent``, or on one line if it's ``None``.
+    """
+    if format == 'unified':
+        lines = unified_diff(old, new, fromfile=url, tofile=url,
+            fromfiledate=from_date, tofiledate=to_date, lineterm='')
+    elif format == 'compact':
+        lines = compact_diff(old, new)
+    elif format == 'json':
+        removed, added = changes(old, new)
+        lines = [ json.dumps({
+          'url': url,
+          'from': from_date and from_date.isoformat(),
+          'to': to_date and to_date.isoformat(),
+          'removed': removed,
+          'added': added,
+        }, indent=indent, sort_keys=True) ]
+    else:
+        raise ValueError('unknown diff format "%s" (choose from: %s)' % \
+            (format, ', '.join(FORMATS)))
+    return '\n'.join(lines) + '\n'
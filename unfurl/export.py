@@ -0,0 +1,159 @@
+import binascii
+import datetime
+import logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from unfurl.db import Snapshot, MAX_VARIABLES
+from unfurl.page import PageSnapshot
+from unfurl.util import chunked
+
+LOG = logging.getLogger(__name__)
+
+class FormatUnavailable(RuntimeError): pass
+
+# bytes of output buffered between writes
+BUFFER_SIZE = 1024 * 1024
+
+CREATED_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+def _parse_created(value):
+    for format in CREATED_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('could not understand snapshot time "%s"' % value)
+
+def record(snapshot):
+    """
+    The exported form of the ``Snapshot`` row ``snapshot``. Rows from
+    before hashers were recorded get their SHA-512 digest, so every record
+    carries a hasher and a binary digest.
+    """
+    digest, hasher = snapshot.stored_digest
+    return {
+      'url': snapshot.url,
+      'regex': snapshot.regex,
+      'created': snapshot.created.isoformat(),
+      'links': snapshot.links,
+      'hasher': hasher,
+      'digest': digest,
+    }
+
+def _jsonl_dumps(record):
+    record = dict(record, digest=binascii.hexlify(record['digest']))
+    return json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n'
+
+def _jsonl_loads(fd):
+    for line in fd:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        record['digest'] = binascii.unhexlify(record['digest'])
+        yield record
+
+def _msgpack_dumps(record):
+    return msgpack.packb(record)
+
+def _msgpack_loads(fd):
+    for record in msgpack.Unpacker(fd, raw=True):
+        # strings come back as bytes; only the links want to be unicode
+        record['links'] = [ i.decode('utf-8') for i in record['links'] ]
+        yield record
+
+# name -> (record serializer, file deserializer, what it needs)
+FORMATS = {
+  'jsonl': (_jsonl_dumps, _jsonl_loads, None),
+  'msgpack': (_msgpack_dumps, _msgpack_loads, 'msgpack 0.5.2 or newer'),
+}
+DEFAULT_FORMAT = 'jsonl'
+
+def _available(name):
+    if name == 'msgpack':
+        return msgpack is not None and msgpack.version >= (0, 5, 2)
+    return True
+
+def get_format(name=None):
+    """
+    Return the ``(serializer, deserializer)`` of the export format called
+    ``name``
+    """
+    name = name or DEFAULT_FORMAT
+    try:
+        dumps, loads, requirement = FORMATS[name]
+    except KeyError:
+        raise FormatUnavailable('unknown export format "%s" (choose from: '
+            '%s)' % (name, ', '.join(sorted(FORMATS))))
+    if not _available(name):
+        raise FormatUnavailable('the %s export format requires %s' % \
+            (name, requirement))
+    return dumps, loads
+
+def export_snapshots(fd, format=None, since=None, until=None, urls=None,
+  match=None):
+    """
+    Write the snapshots taken between ``since`` and ``until`` (of ``urls``,
+    or pages matching the ``GLOB`` pattern ``match``) to ``fd`` in
+    ``format``, one record each, oldest first (by when they were taken:
+    ``import --append`` can leave ids out of time order). Rows are read a
+    page at a time from one cursor and written out ``BUFFER_SIZE`` bytes at
+    a time, so memory use doesn't grow with the table. Returns how many
+    there were.
+    """
+    dumps = get_format(format)[0]
+    query = Snapshot.between(since=since, until=until, urls=urls,
+        match=match).order_by(Snapshot.created, Snapshot.id)
+
+    count = size = 0
+    pending = []
+    for snapshot in query.iterator():
+        data = dumps(record(snapshot))
+        pending.append(data)
+        size += len(data)
+        count += 1
+        if size >= BUFFER_SIZE:
+            fd.write(''.join(pending))
+            pending, size = [], 0
+    fd.write(''.join(pending))
+    return count
+
+def import_snapshots(db, fd, format=None, batch_size=10000):
+    """
+    Add the snapshots exported to ``fd`` in ``format`` to ``db``, stored in
+    its storage mode and keeping their times, hashers and digests.
+    ``batch_size`` of them are committed per transaction, in multi-row
+    inserts. Returns how many there were.
+    """
+    loads = get_format(format)[1]
+    # the most rows sqlite takes per insert, given its variable limit
+    rows_per_insert = max(MAX_VARIABLES // len(Snapshot._meta.fields), 1)
+
+    def rows(records):
+        for record in records:
+            snapshot = PageSnapshot(record['url'], record['links'],
+                record['regex'], hasher=record['hasher'],
+                digest=record['digest'])
+            yield {
+              'url': snapshot.url,
+              'created': _parse_created(record['created']),
+              'data': Snapshot.encode(snapshot, db.storage),
+              'regex': snapshot.regex,
+              'encoding': db.storage,
+              'hasher': snapshot.hasher,
+              'digest': snapshot.digest,
+            }
+
+    count = 0
+    for batch in chunked(loads(fd), batch_size):
+        with db.transaction():
+            for chunk in chunked(rows(batch), rows_per_insert):
+                Snapshot.insert_many(chunk).execute()
+        count += len(batch)
+        LOG.debug('imported %d snapshots' % count)
+    return count
@@ -0,0 +1,92 @@
+import BaseHTTPServer
+import logging
+import os
+import threading
+from unfurl.metrics import REGISTRY
+
+LOG = logging.getLogger(__name__)
+
+# Exporters of the metrics in unfurl.metrics. Only crawls run them, so the
+# http server stays out of the commands that don't.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        LOG.debug('metrics request: ' + format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """
+    Serves ``registry`` at ``/metrics`` from a background thread
+    """
+    allow_reuse_address = True
+
+    def __init__(self, address, registry=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _MetricsHandler)
+        self.registry = registry or REGISTRY
+
+    def start(self):
+        LOG.info('serving metrics on http://%s:%d/metrics' % \
+            self.server_address)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MetricsFile(object):
+    """
+    Rewrites ``filename`` with ``registry`` every ``interval`` seconds (for
+    node_exporter's textfile collector, say). Each write goes to a
+    temporary file renamed into place, so readers never see half of one.
+    """
+    def __init__(self, filename, interval=15, registry=None):
+        self.filename = filename
+        self.interval = interval
+        self.registry = registry or REGISTRY
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def write(self):
+        partial = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(partial, 'w') as fd:
+            fd.write(self.registry.render())
+        os.rename(partial, self.filename)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.write()
+            except (IOError, OSError), e:
+                LOG.error('could not write metrics to %s: %s' % \
+                    (self.filename, e))
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        LOG.info('writing metrics to %s every %s seconds' % \
+            (self.filename, self.interval))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        # leave the final numbers behind
+        self.write()
@@ -0,0 +1,191 @@
+import HTMLParser
+import logging
+import re
+from unfurl.util import LazyModule, importable
+
+# imported when an extractor first needs them; lxml is optional
+bs4 = LazyModule('bs4')
+etree = LazyModule('lxml.etree')
+
+LOG = logging.getLogger(__name__)
+
+class ExtractorUnavailable(RuntimeError): pass
+
+class Extractor(object):
+    """
+    Collects the sorted, de-duplicated ``href`` values of all anchors whose
+    target matches ``regex``.
+
+    Markup is handed over with ``feed`` (in as many pieces as convenient)
+    and the links come back from ``close``. Extractors with ``incremental``
+    set parse each piece as it arrives; the others buffer until ``close``.
+    """
+    incremental = False
+
+    def __init__(self, regex):
+        self.regex = re.compile(regex)
+        self._chunks = []
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        markup = ''.join(self._chunks)
+        self._chunks = []
+        return self._sorted(self.parse(markup))
+
+    def parse(self, markup):
+        """
+        Return an iterable of matching links found in ``markup``
+        """
+        raise NotImplementedError
+
+    def _sorted(self, links):
+        result = list(set(links))
+        result.sort()
+        return result
+
+    @classmethod
+    def extract(cls, markup, regex):
+        extractor = cls(regex)
+        extractor.feed(markup)
+        return extractor.close()
+
+class SoupExtractor(Extractor):
+    """
+    Builds a full BeautifulSoup document tree and searches it
+    """
+    def parse(self, markup):
+        return [ i['href'] for i in \
+            bs4.BeautifulSoup(markup).findAll('a', href=self.regex) ]
+
+class _AnchorParser(HTMLParser.HTMLParser):
+    def __init__(self, regex, found):
+        HTMLParser.HTMLParser.__init__(self)
+        self._search = regex.search
+        self._found = found
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+
+        # the first href wins and a valueless one is empty, as in
+        # BeautifulSoup
+        for name, value in attrs:
+            if name == 'href':
+                href = value or ''
+                break
+        else:
+            return
+
+        if self._search(href):
+            self._found.add(href)
+
+class StreamExtractor(Extractor):
+    """
+    Tokenizes the markup with ``HTMLParser`` and keeps only matching
+    ``href`` values; no document tree is ever built. ``HTMLParser`` gives
+    up on some markup the other backends get past (such as an unknown
+    ``<![...]>`` section); the links found before that point are kept.
+    """
+    incremental = True
+
+    def __init__(self, regex):
+        super(StreamExtractor, self).__init__(regex)
+        self._found = set()
+        self._parser = _AnchorParser(self.regex, self._found)
+
+    def feed(self, data):
+        if self._parser is None:
+            return
+        try:
+            self._parser.feed(data)
+        except HTMLParser.HTMLParseError, e:
+            self._give_up(e)
+
+    def close(self):
+        if self._parser is not None:
+            try:
+                self._parser.close()
+            except HTMLParser.HTMLParseError, e:
+                self._give_up(e)
+        return self._sorted(self._found)
+
+    def _give_up(self, error):
+        # the parser can't carry on past an error, so the rest is ignored
+        LOG.debug('stopped extracting links: %s' % error)
+        self._parser = None
+
+class _AnchorTarget(object):
+    def __init__(self, regex, found):
+        self._search = regex.search
+        self._found = found
+
+    def start(self, tag, attrib):
+        if tag != 'a':
+            return
+
+        href = attrib.get('href')
+        if href is not None and self._search(href):
+            self._found.add(href)
+
+    def end(self, tag):
+        pass
+
+    def close(self):
+        return self._found
+
+class LxmlExtractor(Extractor):
+    """
+    Feeds libxml2's HTML parser with a SAX-style target, so no tree is
+    built. Only available when ``lxml`` is installed.
+    """
+    incremental = True
+
+    def __init__(self, regex):
+        super(LxmlExtractor, self).__init__(regex)
+        self._found = set()
+        self._parser = etree.HTMLParser(
+            target=_AnchorTarget(self.regex, self._found))
+        self._partial = ''
+
+    def feed(self, data):
+        # libxml2 loses the rest of the document when a chunk ends inside
+        # the ``</script`` closing a script, so never hand it half a tag
+        data = self._partial + data
+        start = data.rfind('<')
+        if start != -1 and data.find('>', start) == -1:
+            data, self._partial = data[:start], data[start:]
+        else:
+            self._partial = data[:0]
+        if data:
+            self._parser.feed(data)
+
+    def close(self):
+        if self._partial:
+            self._parser.feed(self._partial)
+            self._partial = ''
+        try:
+            self._parser.close()
+        except etree.XMLSyntaxError:
+            # nothing (or only whitespace) was fed
+            pass
+        return self._sorted(self._found)
+
+EXTRACTORS = {
+  'soup': SoupExtractor,
+  'stream': StreamExtractor,
+  'lxml': LxmlExtractor,
+}
+DEFAULT_EXTRACTOR = 'soup'
+
+def get_extractor(name=None):
+    name = name or DEFAULT_EXTRACTOR
+    try:
+        extractor = EXTRACTORS[name]
+    except KeyError:
+        raise ExtractorUnavailable('unknown link extractor "%s" (choose '
+            'from: %s)' % (name, ', '.join(sorted(EXTRACTORS))))
+    if extractor is LxmlExtractor and not importable(etree):
+        raise ExtractorUnavailable('the lxml link extractor requires lxml')
+    return extractor
@@ -0,0 +1,78 @@
+import hashlib
+import logging
+from unfurl.util import LazyModule, importable
+
+LOG = logging.getLogger(__name__)
+
+# optional hash backends, imported when a hasher needs them; hashlib has
+# blake2b from python 3.6
+pyblake2 = LazyModule('pyblake2')
+xxhash = LazyModule('xxhash')
+
+class HasherUnavailable(RuntimeError): pass
+
+def _blake2b():
+    blake2b = getattr(hashlib, 'blake2b', None) or pyblake2.blake2b
+    # 128 bits is plenty to tell one page's link sets apart
+    return blake2b(digest_size=16)
+
+def _xxh64():
+    return xxhash.xxh64()
+
+def _xxh128():
+    return xxhash.xxh128()
+
+# name -> (factory for a hashlib-style object, what it needs)
+HASHERS = {
+  'sha512': (hashlib.sha512, None),
+  'blake2b': (_blake2b, 'python 3.6 or pyblake2'),
+  'xxh64': (_xxh64, 'xxhash'),
+  'xxh128': (_xxh128, 'xxhash 2.0 or newer'),
+}
+# what snapshots were always checksummed with, and what rows without a
+# recorded hasher used
+DEFAULT_HASHER = 'sha512'
+
+def _available(name):
+    if name == 'blake2b':
+        return hasattr(hashlib, 'blake2b') or importable(pyblake2)
+    if name == 'xxh64':
+        return importable(xxhash)
+    if name == 'xxh128':
+        return importable(xxhash) and hasattr(xxhash, 'xxh128')
+    return True
+
+def get_hasher(name=None):
+    """
+    Return a factory for new hash objects of the hasher called ``name``
+    """
+    name = name or DEFAULT_HASHER
+    try:
+        factory, requirement = HASHERS[name]
+    except KeyError:
+        raise HasherUnavailable('unknown hasher "%s" (choose from: %s)' % \
+            (name, ', '.join(sorted(HASHERS))))
+    if not _available(name):
+        raise HasherUnavailable('the %s hasher requires %s' % \
+            (name, requirement))
+    return factory
+
+# links hashed per update(); big enough to amortize the per-call cost,
+# small enough that the joined chunk stays a fraction of a large page
+CHUNK_LINKS = 256
+
+def digest_links(links, hasher=None):
+    """
+    Hash the sorted list ``links`` with the hasher called ``hasher``,
+    NUL-separated and a chunk at a time. This gives the digest of the
+    NUL-joined list (``PageSnapshot.blob``) without building it.
+    """
+    digest = get_hasher(hasher)()
+    for start in xrange(0, len(links), CHUNK_LINKS):
+        chunk = '\x00'.join(links[start:start + CHUNK_LINKS])
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        if start:
+            digest.update('\x00')
+        digest.update(chunk)
+    return digest.digest()
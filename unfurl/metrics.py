@@ -0,0 +1,170 @@
+import bisect
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the histogram buckets stage timings fall in
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in items)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Counter(object):
+    """
+    A value that only goes up
+    """
+    type = 'counter'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield '%s%s %s' % (name, _labels(labels), _number(self.value))
+
+class Gauge(object):
+    """
+    A value that goes up and down, or is just set
+    """
+    type = 'gauge'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self, name, labels):
+        yield '%s%s %s' % (name, _labels(labels), _number(self.value))
+
+class Histogram(object):
+    """
+    Counts observations into cumulative buckets, keeping their sum
+    """
+    type = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self._counts), self.sum, self.count
+        cumulative = 0
+        bounds = self.buckets + (float('inf'),)
+        for bound, bucket in zip(bounds, counts):
+            cumulative += bucket
+            yield '%s_bucket%s %d' % (name,
+                _labels(labels, [('le', _number(bound))]), cumulative)
+        yield '%s_sum%s %s' % (name, _labels(labels), _number(total))
+        yield '%s_count%s %d' % (name, _labels(labels), count)
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+class Registry(object):
+    """
+    Named metrics, each optionally split by labels, that can be rendered in
+    the Prometheus text exposition format. Getting a metric creates it on
+    first use; hot paths should keep hold of the metric rather than look
+    it up every time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help, {sorted label items: metric})
+        self._families = {}
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (cls, help, {})
+            elif family[0] is not cls:
+                raise ValueError('metric %s is already a %s' % \
+                    (name, family[0].type))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(**kwargs)
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            families = [ (name, cls, help, sorted(metrics.items())) for \
+                name, (cls, help, metrics) in sorted(self._families.items()) ]
+
+        lines = []
+        for name, cls, help, metrics in families:
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, cls.type))
+            for labels, metric in metrics:
+                lines.extend(metric.samples(name, labels))
+        return '\n'.join(lines) + '\n'
+
+# the process-wide registry unfurl's own metrics live in
+REGISTRY = Registry()
+
+def stage(name):
+    """
+    The histogram of how long the crawl stage ``name`` takes
+    """
+    return REGISTRY.histogram('unfurl_stage_seconds',
+        'Time spent in each stage of crawling a page', stage=name)
@@ -1,62 +1,333 @@
-import requests
+import base64
+import binascii
+import codecs
 import logging
-import re
-from bs4 import BeautifulSoup
 import hashlib
 import sqlite3
 import os
-from unfurl.util import timeit
+import random
+import time
+import urlparse
+from unfurl.metrics import stage
+from unfurl.util import timeit, LazyModule
+from unfurl.extract import get_extractor
+from unfurl.hashing import digest_links, DEFAULT_HASHER
 
 LOG = logging.getLogger(__name__)
 
-def get_page(url):
-    LOG.debug('fetching page: %s' % url)
+# only crawls need requests
+requests = LazyModule('requests')
+
+# server errors worth trying again
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# bytes read from a response body at a time
+CHUNK_SIZE = 64 * 1024
+
+# requests doesn't expose DNS and connect times separately; headers covers
+# everything up to the response headers
+FETCH_SECONDS = stage('fetch')
+HEADERS_SECONDS = stage('fetch_headers')
+BODY_SECONDS = stage('fetch_body')
+PARSE_SECONDS = stage('parse')
+HASH_SECONDS = stage('hash')
+
+def get_page(url, headers=None, session=None, timeout=None, retries=0,
+  backoff=0.5, counters=None):
+    """
+    Fetch ``url``'s headers; the body is left unread for ``read_body`` to
+    stream. Gives up on a connection or read that takes longer than
+    ``timeout`` (seconds, or a ``(connect, read)`` tuple). Connection
+    errors, timeouts and retryable server errors are retried up to
+    ``retries`` times, sleeping a random ("full jitter") fraction of
+    ``backoff * 2 ** attempt`` seconds in between; any other request error
+    fails at once. Returns ``None`` if the page couldn't be fetched; if
+    ``counters`` is given, retries and timeouts are counted on it.
+    """
+    attempt = 0
+    while True:
+        LOG.debug('fetching page: %s' % url)
+        try:
+            with HEADERS_SECONDS.time():
+                page = (session or requests).get(url, headers=headers,
+                    timeout=timeout, stream=True)
+        except requests.exceptions.MissingSchema, e:
+            LOG.error(e.args[0])
+            return None
+        except (requests.exceptions.Timeout,
+          requests.exceptions.ConnectionError), e:
+            if isinstance(e, requests.exceptions.Timeout) and counters:
+                counters.incr('timeouts')
+            if attempt >= retries:
+                LOG.error('could not fetch %s: %s' % (url, e))
+                return None
+            LOG.debug('fetching %s failed: %s' % (url, e))
+        except requests.exceptions.RequestException, e:
+            # a bad URL, redirect loop and the like: no point trying again
+            LOG.error('could not fetch %s: %s' % (url, e))
+            return None
+        else:
+            LOG.debug('response headers: %s' % page.headers)
+            if page.status_code not in RETRY_STATUSES or attempt >= retries:
+                return page
+            LOG.debug('fetching %s failed: HTTP %d' % (url, page.status_code))
+            page.close()
+
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        attempt += 1
+        if counters:
+            counters.incr('retries')
+        LOG.debug('retry %d of %d in %.2f seconds' % (attempt, retries, delay))
+        time.sleep(delay)
+
+def _is_timeout(error):
+    # requests reports a read timing out mid-body as a ConnectionError
+    # wrapping urllib3's ReadTimeoutError
+    return isinstance(error, requests.exceptions.Timeout) or \
+        isinstance(error.args and error.args[0],
+            requests.packages.urllib3.exceptions.ReadTimeoutError)
+
+def _codec(encoding):
+    """
+    ``encoding`` if Python knows it, otherwise utf-8, as requests falls
+    back to for charsets it can't decode
+    """
     try:
-        page = requests.get(url)
-    except requests.exceptions.MissingSchema, e:
-        LOG.error(e.args[0])
+        return codecs.lookup(encoding).name
+    except LookupError:
+        LOG.debug('unknown charset "%s", decoding as utf-8' % encoding)
+        return 'utf-8'
+
+class ResponseRejected(RuntimeError): pass
+
+@timeit('body read', BODY_SECONDS)
+def read_body(response, max_size=0, consumer=None):
+    """
+    Stream ``response``'s body (decompressed, if it was sent with a gzip or
+    deflate transfer encoding) in chunks, giving up with
+    ``ResponseRejected`` as soon as more than ``max_size`` bytes arrive
+    (0 means no limit). Chunks are passed to ``consumer`` if given,
+    otherwise they're collected. Returns ``(body, digest)``, where body is
+    ``None`` if it went to ``consumer`` and digest is the MD5 of the body.
+    """
+    length = response.headers.get('content-length')
+    if max_size and length and length.isdigit() and int(length) > max_size:
+        response.close()
+        raise ResponseRejected('body of %s bytes exceeds the %d byte limit' % \
+            (length, max_size))
+
+    digest = hashlib.md5()
+    chunks = []
+    size = 0
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise ResponseRejected('body exceeds the %d byte limit' % \
+                    max_size)
+            digest.update(chunk)
+            if consumer:
+                consumer(chunk)
+            else:
+                chunks.append(chunk)
+    finally:
+        response.close()
+
+    body = None if consumer else ''.join(chunks)
+    return body, digest.hexdigest()
+
+@timeit('link extraction', PARSE_SECONDS)
+def extract_links(markup, regex, extractor=None):
+    """
+    Return the sorted, de-duplicated ``href`` values of all anchors in
+    ``markup`` matching ``regex``, using the named link extractor (see
+    ``unfurl.extract``)
+    """
+    if not markup:
         return None
-    LOG.debug('response headers: %s' % page.headers)
-    return page
+
+    return get_extractor(extractor).extract(markup, regex)
+
+def parse_markup(markup, regex, extractor=None, hasher=None):
+    """
+    Extract links from ``markup`` and hash them. Returns a
+    ``(links, digest)`` tuple; this is what the crawler's parse pool runs
+    in its worker processes.
+    """
+    snapshot = PageSnapshot(links=extract_links(markup, regex, extractor) or [],
+        regex=regex, hasher=hasher)
+    return snapshot.links, snapshot.digest
 
 class Page(object):
-    def __init__(self, url, regex=None, autoload=False):
+    # crawls hold a Page per URL for as long as they run, so keep them small:
+    # only the parts of a response that are needed are copied out of it
+    __slots__ = ('url', 'regex', 'extractor', 'hasher', 'period', 'status',
+        'etag', 'last_modified', 'rejected', '_encoding', '_body', '_digest',
+        '_links', '_snapshot')
+
+    def __init__(self, url, regex=None, autoload=False, extractor=None,
+      period=None, hasher=None):
         self.url = self._normalize_url(url)
-        self._request = None
+        self.status = None
+        self.etag = None
+        self.last_modified = None
+        self.rejected = None
+        self._encoding = None
+        self._body = None
+        self._digest = None
+        self._links = None
+        self._snapshot = None
         self.regex = regex or '.+'
+        self.extractor = extractor
+        # the name of the hasher ``snapshot`` digests the links with
+        self.hasher = hasher
+        # seconds between crawls of this page; None uses the crawler's
+        self.period = period
 
         if autoload:
             self.load()
 
-    @timeit('page load')
-    def load(self):
-        self._request = get_page(self.url)
+    @timeit('page load', FETCH_SECONDS)
+    def load(self, etag=None, last_modified=None, session=None, max_size=0,
+      content_types=None, extractor=None, **kwargs):
+        """
+        Fetch the page. If validators from a previous fetch are given, the
+        request is made conditional so an unchanged page comes back as an
+        empty ``304 Not Modified``. Pass a ``requests.Session`` to reuse its
+        pooled connections. Other keyword arguments (timeouts, retries) are
+        passed on to ``get_page``.
+
+        The body is streamed. A response whose media type isn't one of
+        ``content_types`` (if given) is dropped before its body is read,
+        and one larger than ``max_size`` bytes is abandoned part way; either
+        way ``rejected`` says why. Given an incremental ``extractor``
+        instance, the body is fed to it as it arrives instead of being
+        kept, and ``links`` comes from it.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        self.release()
+        self.status = self.etag = self.last_modified = self.rejected = None
+        self._digest = None
+        response = get_page(self.url, headers=headers, session=session,
+            **kwargs)
+        if response is None:
+            return
+
+        self.status = response.status_code
+        self.etag = response.headers.get('etag')
+        self.last_modified = response.headers.get('last-modified')
+        self._encoding = response.encoding
+
+        if self.failed or not self.modified:
+            response.close()
+            return
+
+        try:
+            self._check_content_type(response, content_types)
+            if extractor is None:
+                self._body, self._digest = read_body(response, max_size)
+            else:
+                self._digest = self._stream_to(response, extractor, max_size)
+        except ResponseRejected, e:
+            LOG.warning('skipping %s: %s' % (self.url, e.args[0]))
+            self.rejected = e.args[0]
+        except requests.exceptions.RequestException, e:
+            # the connection dropped, stalled or sent garbage mid-body: treat
+            # it like a failed fetch
+            LOG.error('could not read %s: %s' % (self.url, e))
+            counters = kwargs.get('counters')
+            if counters and _is_timeout(e):
+                counters.incr('timeouts')
+            self.status = None
+            self._body = self._digest = self._links = None
+
+    def release(self):
+        """
+        Drop the fetched body and anything parsed from it, keeping only
+        what's needed to make the next fetch conditional
+        """
+        self._body = None
+        self._links = None
+        self._snapshot = None
+
+    def _check_content_type(self, response, content_types):
+        content_type = response.headers.get('content-type')
+        if not (content_types and content_type):
+            return
+        media_type = content_type.split(';')[0].strip().lower()
+        if media_type not in content_types:
+            response.close()
+            raise ResponseRejected('content type %s is not one of %s' % \
+                (media_type, ', '.join(content_types)))
+
+    def _stream_to(self, response, extractor, max_size):
+        decoder = codecs.getincrementaldecoder(
+            _codec(self._encoding or 'utf-8'))(errors='replace')
+        body, digest = read_body(response, max_size,
+            consumer=lambda chunk: extractor.feed(decoder.decode(chunk)))
+        extractor.feed(decoder.decode('', True))
+        self._links = extractor.close()
+        return digest
 
     @property
     def loaded(self):
-        return self._request is not None
+        return self.status is not None
 
-    def _normalize_url(self, url):
-        return url.rstrip('/')
+    @property
+    def failed(self):
+        """
+        Whether the page couldn't be fetched or the server errored
+        """
+        return self.status is None or self.status >= 500
 
     @property
-    def markup(self):
-        return self._request.text
+    def modified(self):
+        return self.status != requests.codes.not_modified
 
     @property
-    def links(self):
-        if not self.markup:
-            return None
+    def digest(self):
+        """
+        A cheap fingerprint of the raw response body, used to spot pages
+        that are byte-for-byte unchanged without parsing them
+        """
+        return self._digest
 
-        regex = re.compile(self.regex)
+    @property
+    def host(self):
+        return urlparse.urlparse(self.url).netloc.lower()
 
-        items = [ i['href'] for i in \
-            BeautifulSoup(self.markup).findAll('a', href=regex) ] 
+    def _normalize_url(self, url):
+        return url.rstrip('/')
+
+    @property
+    def markup(self):
+        if self._body is None:
+            return None
+        # decode as requests' Response.text would
+        encoding = self._encoding or \
+            requests.compat.chardet.detect(self._body)['encoding'] or 'utf-8'
+        return unicode(self._body, _codec(encoding), errors='replace')
 
-        result = list(set(items))
-        result.sort()
+    @property
+    def parsed(self):
+        """
+        Whether links were already extracted, either while the body streamed
+        in or by an earlier look at ``links``
+        """
+        return self._links is not None
 
-        return result
+    @property
+    def links(self):
+        # parsed once per load
+        if self._links is None:
+            self._links = extract_links(self.markup, self.regex,
+                self.extractor)
+        return self._links
 
     @property
     def snapshot(self, regex='.*'):
@@ -67,46 +338,79 @@ class Page(object):
             * The list of links
             * A crytographic hash representing the data
         """
-        return PageSnapshot(self.url, self.links, self.regex)
+        if self._snapshot is None:
+            self._snapshot = PageSnapshot(self.url, self.links or [],
+                self.regex, hasher=self.hasher)
+        return self._snapshot
 
 class PageSnapshot(object):
-    DEFAULT_HASH_FUNCTION = hashlib.sha512
+    __slots__ = ('url', 'links', 'regex', 'hasher', 'encoding', '_blob',
+        '_digest')
+
     DEFAULT_HASH_ENCODING = 'hex'
 
     def __init__(self, url=None, links=[], regex=None, hasher=None,
-      encoding=None):
+      encoding=None, digest=None):
         self.url = url
         self.links = links
         self.regex = regex
-        self.hasher = hasher or self.DEFAULT_HASH_FUNCTION
+        # the name of a hasher in unfurl.hashing
+        self.hasher = hasher or DEFAULT_HASHER
         self.encoding = encoding or self.DEFAULT_HASH_ENCODING
         self.links.sort()
+        # blob and digest are worked out once, so links shouldn't change
+        # after construction; the digest may also have been computed
+        # elsewhere (e.g. in a parse worker)
+        self._blob = None
+        self._digest = digest
 
     def __eq__(self, other):
         return other.url == self.url and \
                other.regex == self.regex and \
-               other.checksum == self.checksum
+               other.hasher == self.hasher and \
+               other.digest == self.digest
 
     @property
     def blob(self):
         """
         Create a unique representation of the link data
         """
-        self.links.sort()
-        return '\x00'.join(self.links)
+        if self._blob is None:
+            self.links.sort()
+            self._blob = '\x00'.join(self.links)
+        return self._blob
 
     @classmethod
     def unblob(cls, blob):
-        return unicode(blob).encode('utf-8').split('\x00')
+        if isinstance(blob, unicode):
+            blob = blob.encode('utf-8')
+        # blobs read back from sqlite are buffers of utf-8
+        return str(blob).split('\x00')
+
+    @property
+    def digest(self):
+        """
+        The binary digest of the link data (that is, of ``blob``)
+        """
+        if self._digest is None:
+            with HASH_SECONDS.time():
+                self._digest = digest_links(self.links, self.hasher)
+        return self._digest
 
     @property
     def checksum(self):
-        return self.hasher(self.blob).hexdigest()
+        """
+        ``digest``, as text in ``encoding`` (hex or base64)
+        """
+        if self.encoding == 'base64':
+            return base64.b64encode(self.digest)
+        return binascii.hexlify(self.digest)
 
     def json(self):
         return {
           'url': self.url,
           'links': self.links,
           'regex': self.regex,
+          'hasher': self.hasher,
           'checksum': self.checksum,
         }
@@ -0,0 +1,164 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from unfurl.util import LazyModule
+
+LOG = logging.getLogger(__name__)
+
+# only needed once a command is actually profiled
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+
+PROFILERS = ('deterministic', 'sampling')
+
+class DeterministicProfiler(object):
+    """
+    Runs ``cProfile`` in the thread that starts it and in every thread
+    started while it runs, merging them all into one set of ``pstats``
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []
+        self.stats = None
+
+    def _add(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def _thread_started(self, frame, event, arg):
+        # installed by threading.setprofile as a new thread's first profile
+        # hook; enabling cProfile there replaces it
+        self._add()
+
+    def start(self):
+        threading.setprofile(self._thread_started)
+        self._add()
+
+    def stop(self):
+        threading.setprofile(None)
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        # this disables each profile, and this thread's profiling
+        self.stats = pstats.Stats(*profiles)
+
+    def save(self, filename):
+        self.stats.dump_stats(filename)
+
+    def summary(self, stream, limit=20):
+        self.stats.stream = stream
+        self.stats.sort_stats('tottime').print_stats(limit)
+
+def _frame_label(code):
+    filename = os.path.join(*code.co_filename.split(os.sep)[-2:])
+    return ('%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)) \
+        .replace(';', ':')
+
+class SamplingProfiler(object):
+    """
+    Records the stack of every other thread each ``interval`` seconds of
+    wall-clock time, from a background thread. Threads waiting (on the
+    network, a queue, a lock) are sampled as well as busy ones. Stacks are
+    kept in the collapsed format flamegraph tools read.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # (outermost label, ..., innermost label) -> samples
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def save(self, filename):
+        with open(filename, 'w') as fd:
+            for stack, count in sorted(self.stacks.items()):
+                fd.write('%s %d\n' % (';'.join(stack), count))
+
+    def summary(self, stream, limit=20):
+        total = sum(self.stacks.values())
+        own, inclusive = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            # recursion shouldn't count a function more than once a sample
+            for label in set(stack):
+                inclusive[label] += count
+
+        stream.write('%d samples, every %.1f ms\n\n' % (total,
+            self.interval * 1000))
+        stream.write('%7s %7s  %s\n' % ('self%', 'total%', 'function'))
+        for label, count in own.most_common(limit):
+            stream.write('%7.1f %7.1f  %s\n' % (count * 100.0 / total,
+                inclusive[label] * 100.0 / total, label))
+
+def get_profiler(name='deterministic', interval=0.005):
+    if name == 'deterministic':
+        return DeterministicProfiler()
+    if name == 'sampling':
+        return SamplingProfiler(interval=interval)
+    raise ValueError('unknown profiler "%s" (choose from: %s)' % \
+        (name, ', '.join(PROFILERS)))
+
+class profiled(object):
+    """
+    Profile the ``with`` block with the profiler called ``profiler``,
+    saving the results to ``filename`` (``pstats`` for the deterministic
+    profiler, collapsed stacks for the sampling one) and writing a summary
+    of the top ``limit`` hot spots to ``stream`` on the way out. With no
+    ``filename`` nothing is profiled.
+    """
+    def __init__(self, filename, profiler='deterministic', interval=0.005,
+      stream=None, limit=20):
+        self.filename = filename
+        self.profiler = filename and get_profiler(profiler, interval)
+        self.stream = stream or sys.stderr
+        self.limit = limit
+
+    def __enter__(self):
+        if self.profiler:
+            LOG.info('profiling to %s' % self.filename)
+            self.profiler.start()
+        return self.profiler
+
+    def __exit__(self, *exc_info):
+        if not self.profiler:
+            return
+        self.profiler.stop()
+        try:
+            self.profiler.save(self.filename)
+        except (IOError, OSError), e:
+            LOG.error('could not save the profile to %s: %s' % \
+                (self.filename, e))
+        self.stream.write('\nprofile saved to %s; top hot spots:\n\n' % \
+            self.filename)
+        self.profiler.summary(self.stream, self.limit)
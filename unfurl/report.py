@@ -0,0 +1,67 @@
+import collections
+import logging
+import multiprocessing
+from unfurl.db import Snapshot
+from unfurl.diff import format_diff
+from unfurl.util import chunked, ignore_interrupts
+
+LOG = logging.getLogger(__name__)
+
+def pairs(changes):
+    """
+    Turn ``Snapshot.changes`` results into ``(old links, new links, url,
+    from date, to date)`` tuples. A page's first snapshot is compared with
+    no links at all.
+    """
+    for previous, snapshot in changes:
+        if previous is None:
+            old, from_date = [], None
+        else:
+            old, from_date = previous.links, previous.created
+        yield old, snapshot.links, snapshot.url, from_date, snapshot.created
+
+def render(item, format='unified'):
+    old, new, url, from_date, to_date = item
+    # one JSON document per line, so reports can be streamed
+    diff = format_diff(old, new, format=format, url=url, from_date=from_date,
+        to_date=to_date, indent=None)
+    if format == 'compact':
+        # compact diffs don't say which page they're for on their own
+        diff = '%s\t%s\n%s' % (url, to_date, diff)
+    return diff
+
+def render_all(items, format='unified'):
+    return [ render(i, format) for i in items ]
+
+def report(since=None, until=None, urls=None, match=None, format='unified',
+  processes=0, chunksize=16):
+    """
+    Yield the diff of every change to the matching pages between ``since``
+    and ``until``, oldest first for each page. Snapshots are read and
+    decoded in this process; with ``processes`` set, diffs are rendered in
+    a pool of that many worker processes, ``chunksize`` at a time.
+    """
+    items = pairs(Snapshot.changes(since=since, until=until, urls=urls,
+        match=match))
+
+    if not processes:
+        for item in items:
+            yield render(item, format)
+        return
+
+    pool = multiprocessing.Pool(processes, initializer=ignore_interrupts)
+    # keep every worker busy, but don't read further ahead than that
+    pending = collections.deque()
+    try:
+        for chunk in chunked(items, chunksize):
+            pending.append(pool.apply_async(render_all, (chunk, format)))
+            if len(pending) > processes * 2:
+                for diff in pending.popleft().get():
+                    yield diff
+        while pending:
+            for diff in pending.popleft().get():
+                yield diff
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,74 @@
+import logging
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+
+LOG = logging.getLogger(__name__)
+
+class SessionPool(object):
+    """
+    Hands out keep-alive ``requests.Session`` objects so that pages sharing
+    a host reuse pooled connections instead of paying a new TCP/TLS
+    handshake on every fetch.
+
+    By default each thread gets its own session. With ``shared=True`` every
+    caller uses the same session (and therefore the same connection pools).
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10, shared=False):
+        LOG.info('http pool connections: %s' % pool_connections)
+        LOG.info('http pool max size (per host): %s' % pool_maxsize)
+        LOG.info('shared http session? %s' % shared)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.shared = shared
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shared_session = None
+        self._sessions = weakref.WeakSet()
+
+    def _create(self):
+        # caller must hold self._lock
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self._sessions.add(session)
+        return session
+
+    def reserve(self, size):
+        """
+        Keep at least ``size`` connections per host in sessions created
+        from now on. Greenlets share their thread's session, so the async
+        engine needs pools as big as its concurrency, or connections past
+        ``pool_maxsize`` are thrown away after every fetch.
+        """
+        if size > self.pool_maxsize:
+            LOG.info('http pool max size (per host) raised to %s' % size)
+            self.pool_maxsize = size
+
+    def get(self):
+        """
+        Return the session the calling thread should use
+        """
+        if self.shared:
+            with self._lock:
+                if self._shared_session is None:
+                    self._shared_session = self._create()
+                return self._shared_session
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            with self._lock:
+                session = self._local.session = self._create()
+        return session
+
+    def close(self):
+        LOG.debug('closing http sessions')
+        with self._lock:
+            sessions = list(self._sessions)
+            self._shared_session = None
+        for session in sessions:
+            session.close()
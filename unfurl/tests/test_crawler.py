@@ -0,0 +1,302 @@
+import datetime
+import logging
+import time
+import unittest
+from unfurl.crawler import (
+  Crawler, Executor, Schedule, HostLimits, CircuitBreaker, ParseStage,
+  estimate_period,
+)
+from unfurl.db import Database, Snapshot
+from unfurl.hashing import HasherUnavailable
+from unfurl.page import Page, parse_markup
+from unfurl.tests.test_db import DatabaseTestCase
+from unfurl.tests.test_page import FakeResponse, ScriptedSession
+
+class ExecutorTest(unittest.TestCase):
+    def check_survives_errors(self, threaded):
+        done = []
+        def work(item):
+            if item == 1:
+                raise ValueError('work failed')
+        def callback(item):
+            if item == 2:
+                raise ValueError('callback failed')
+            done.append(item)
+
+        executor = Executor(work, threaded=threaded, max_threads=2)
+        try:
+            for item in xrange(6):
+                executor.submit(item, callback=callback)
+            executor.join()
+        finally:
+            executor.shutdown()
+        self.assertEqual(sorted(done), [0, 1, 3, 4, 5])
+
+    def test_threaded(self):
+        self.check_survives_errors(True)
+
+    def test_unthreaded(self):
+        self.check_survives_errors(False)
+
+class CircuitBreakerTest(unittest.TestCase):
+    HOST = 'example.com'
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=60)
+        self.assertFalse(breaker.failure(self.HOST, 0))
+        self.assertFalse(breaker.failure(self.HOST, 1))
+        self.assertTrue(breaker.allow(self.HOST, 1))
+        self.assertTrue(breaker.failure(self.HOST, 2))
+        self.assertFalse(breaker.allow(self.HOST, 3))
+        # other hosts are unaffected
+        self.assertTrue(breaker.allow('example.org', 3))
+
+    def test_success_resets_the_count(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        breaker.failure(self.HOST, 0)
+        breaker.success(self.HOST)
+        self.assertFalse(breaker.failure(self.HOST, 1))
+        self.assertTrue(breaker.allow(self.HOST, 1))
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=60)
+        self.assertTrue(breaker.failure(self.HOST, 0))
+        self.assertFalse(breaker.allow(self.HOST, 59))
+        # one trial once the cooldown is over, the rest held back
+        self.assertTrue(breaker.allow(self.HOST, 60))
+        self.assertFalse(breaker.allow(self.HOST, 61))
+
+        # a failed trial keeps it open for another cooldown, without
+        # counting as a new trip
+        self.assertFalse(breaker.failure(self.HOST, 61))
+        self.assertFalse(breaker.allow(self.HOST, 120))
+        self.assertTrue(breaker.allow(self.HOST, 121))
+
+        # a successful one closes it
+        breaker.success(self.HOST)
+        self.assertTrue(breaker.allow(self.HOST, 122))
+        self.assertTrue(breaker.allow(self.HOST, 122))
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(threshold=0)
+        for i in xrange(100):
+            self.assertFalse(breaker.failure(self.HOST, i))
+        self.assertTrue(breaker.allow(self.HOST, 100))
+
+class HostLimitsTest(unittest.TestCase):
+    def test_round_robin(self):
+        hosts = HostLimits()
+        for item in xrange(3):
+            hosts.add('a', 'a%d' % item)
+        hosts.add('b', 'b0')
+        taken = [ hosts.take(0) for i in xrange(4) ]
+        self.assertEqual(taken, [('a', 'a0'), ('b', 'b0'), ('a', 'a1'),
+            ('a', 'a2')])
+        self.assertEqual(hosts.take(0), None)
+        self.assertEqual(len(hosts), 0)
+
+    def test_concurrency(self):
+        hosts = HostLimits(concurrency=2)
+        for item in xrange(3):
+            hosts.add('a', item)
+        hosts.add('b', 'b')
+        self.assertEqual(hosts.take(0), ('a', 0))
+        self.assertEqual(hosts.take(0), ('b', 'b'))
+        self.assertEqual(hosts.take(0), ('a', 1))
+        # two in flight for a
+        self.assertEqual(hosts.take(0), None)
+        self.assertEqual(len(hosts), 1)
+        hosts.release('a')
+        self.assertEqual(hosts.take(0), ('a', 2))
+
+    def test_delay(self):
+        hosts = HostLimits(delay=10)
+        for item in xrange(2):
+            hosts.add('a', item)
+        self.assertEqual(hosts.take(100), ('a', 0))
+        hosts.release('a')
+        # the delay runs from when the last request started
+        self.assertEqual(hosts.take(109), None)
+        self.assertEqual(hosts.take(110), ('a', 1))
+
+    def test_overrides(self):
+        hosts = HostLimits(concurrency=1, delay=10,
+            overrides={'fast': {'delay': 0}, 'wide': {'concurrency': 0}})
+        self.assertEqual(hosts.limits('slow'), (1, 10))
+        self.assertEqual(hosts.limits('fast'), (1, 0))
+        self.assertEqual(hosts.limits('wide'), (0, 10))
+
+        for item in xrange(2):
+            hosts.add('fast', item)
+        self.assertEqual(hosts.take(100), ('fast', 0))
+        self.assertEqual(hosts.take(100), None)
+        hosts.release('fast')
+        self.assertEqual(hosts.take(100), ('fast', 1))
+
+class ScheduleTest(unittest.TestCase):
+    def test_earliest_first(self):
+        schedule = Schedule()
+        for due, item in [(30, 'c'), (10, 'a'), (20, 'b')]:
+            schedule.add(due, item)
+        self.assertEqual(len(schedule), 3)
+        self.assertEqual(schedule.next_due(), 10)
+        self.assertEqual(schedule.pop_due(25), (10, 'a'))
+        self.assertEqual(schedule.pop_due(25), (20, 'b'))
+        # not due yet
+        self.assertEqual(schedule.pop_due(25), None)
+        self.assertEqual(schedule.next_due(), 30)
+
+    def test_ties_in_order_added(self):
+        schedule = Schedule()
+        for item in 'abc':
+            schedule.add(10, item)
+        self.assertEqual([ schedule.pop_due(10)[1] for i in xrange(3) ],
+            ['a', 'b', 'c'])
+
+    def test_reschedule(self):
+        schedule = Schedule()
+        schedule.add(0, 'slow')
+        schedule.add(5, 'fast')
+        due, item = schedule.pop_due(0)
+        # back in line one period later, behind anything due sooner
+        schedule.add(due + 10, item)
+        self.assertEqual(schedule.pop_due(10), (5, 'fast'))
+        schedule.add(15, 'fast')
+        self.assertEqual(schedule.pop_due(20), (10, 'slow'))
+        self.assertEqual(schedule.pop_due(20), (15, 'fast'))
+        self.assertEqual(schedule.next_due(), None)
+        self.assertEqual(len(schedule), 0)
+
+class EstimatePeriodTest(unittest.TestCase):
+    NOW = datetime.datetime(2015, 1, 2)
+
+    def now(self):
+        return time.mktime(self.NOW.timetuple())
+
+    def ago(self, *hours):
+        return [ self.NOW - datetime.timedelta(hours=i) for i in hours ]
+
+    def test_no_history(self):
+        self.assertEqual(estimate_period([], self.now(), 600), 600)
+
+    def test_unchanged(self):
+        # one snapshot, a day old: the page has held still for a day
+        self.assertEqual(estimate_period(self.ago(24), self.now(), 600),
+            86400)
+        # but a page only just seen gets the default
+        self.assertEqual(estimate_period(self.ago(0), self.now(), 600), 600)
+
+    def test_change_rate(self):
+        # three changes in the last six hours
+        self.assertEqual(estimate_period(self.ago(1, 3, 4, 6), self.now(),
+            600), 7200)
+
+class AdaptivePeriodTest(DatabaseTestCase):
+    URL = 'http://example.com'
+
+    def crawler(self, **options):
+        return Crawler(db=self.open(), period=600, schedule='adaptive',
+            min_period=60, max_period=3600, log_level=logging.WARNING,
+            threaded=False, **options)
+
+    def add_history(self, *seconds):
+        now = datetime.datetime.now()
+        for i in seconds:
+            Snapshot.create(url=self.URL, regex='.+', data='',
+                created=now - datetime.timedelta(seconds=i))
+
+    def test_clamped_to_min(self):
+        crawler = self.crawler()
+        self.add_history(0, 10, 20)
+        self.assertEqual(crawler.period_for(Page(self.URL)), 60)
+
+    def test_clamped_to_max(self):
+        crawler = self.crawler()
+        self.add_history(86400)
+        self.assertEqual(crawler.period_for(Page(self.URL)), 3600)
+
+    def test_within_bounds(self):
+        crawler = self.crawler()
+        self.add_history(0, 1000, 2000)
+        self.assertTrue(abs(crawler.period_for(Page(self.URL)) - 1000) < 5)
+
+    def test_page_period_wins(self):
+        crawler = self.crawler()
+        self.add_history(0, 10, 20)
+        self.assertEqual(crawler.period_for(Page(self.URL, period=5)), 5)
+
+class StubSessions(object):
+    """
+    A ``SessionPool`` handing out a single ``ScriptedSession``
+    """
+    def __init__(self, responses):
+        self.session = ScriptedSession(responses)
+
+    def get(self):
+        return self.session
+
+    def reserve(self, size):
+        pass
+
+    def close(self):
+        pass
+
+class ConditionalGetTest(DatabaseTestCase):
+    URL = 'http://example.com'
+
+    def response(self, status, body=''):
+        response = FakeResponse([body])
+        response.status_code = status
+        response.headers.update({'etag': '"v1"',
+            'last-modified': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+        return response
+
+    def test_not_modified(self):
+        sessions = StubSessions([self.response(200, '<a href="x">x</a>'),
+            self.response(304)])
+        crawler = Crawler(db=self.open(), period=0, count=2, threaded=False,
+            sessions=sessions, log_level=logging.WARNING)
+        crawler.crawl([Page(self.URL)])
+
+        # nothing to go on the first time, then the validators come back
+        self.assertEqual(sessions.session.sent, [{}, {'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'}])
+        self.assertEqual(crawler.round_stats.get('not_modified'), 1)
+        self.assertEqual(crawler.round_stats.get('new_snapshots'), 1)
+        self.assertEqual(Snapshot.select().count(), 1)
+        self.assertEqual(Database.get_validators(self.URL, '.+')['etag'],
+            '"v1"')
+
+class ParseStageTest(unittest.TestCase):
+    def test_reuses_streamed_snapshot(self):
+        try:
+            parser = ParseStage(extractor='stream', hasher='blake2b')
+        except HasherUnavailable:
+            self.skipTest('blake2b is not installed')
+        page = Page('http://example.com/', regex='^http')
+        page.load(session=ScriptedSession([FakeResponse(
+            ['<a href="http://a/">a</a><a href="/b">b</a>'])]),
+            extractor=parser.stream_extractor(page.regex))
+        self.assertTrue(page.parsed)
+
+        snapshot = parser.snapshot(page)
+        self.assertTrue(snapshot is page.snapshot)
+        self.assertEqual(snapshot.hasher, 'blake2b')
+        self.assertEqual(snapshot.links, ['http://a/'])
+        # hashed as a buffered parse of the same page would be
+        self.assertEqual(snapshot.digest, parse_markup(
+            '<a href="http://a/">a</a>', '^http', 'stream', 'blake2b')[1])
+
+    def test_pool(self):
+        page = Page('http://example.com/')
+        page.load(session=ScriptedSession([FakeResponse(
+            ['<a href="b">b</a><a href="a">a</a>'])]))
+        for cooperative in (False, True):
+            parser = ParseStage(processes=1, cooperative=cooperative)
+            try:
+                snapshot = parser.snapshot(page)
+            finally:
+                parser.shutdown()
+            self.assertEqual(snapshot.links, ['a', 'b'])
+            self.assertEqual(snapshot.digest, parse_markup(page.markup,
+                page.regex)[1])
@@ -0,0 +1,242 @@
+import datetime
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unfurl.db import (
+  Database, Snapshot, Writer, Retention, SCHEMA_VERSION, RAW, ZLIB, INTERNED,
+  _pack_ids, _unpack_ids,
+)
+from unfurl.page import PageSnapshot
+
+# the snapshot table as the first release created it, before migrations
+BASELINE_SCHEMA = '''
+CREATE TABLE "snapshot" (
+  "id" INTEGER NOT NULL PRIMARY KEY,
+  "url" VARCHAR(255) NOT NULL,
+  "created" DATETIME NOT NULL,
+  "data" BLOB NOT NULL,
+  "checksum" VARCHAR(255) NOT NULL,
+  "regex" VARCHAR(255) NOT NULL
+)
+'''
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='unfurl-test-')
+        self.location = os.path.join(self.tmpdir, 'db.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open(self, storage=RAW):
+        return Database(self.location, pragmas=[], storage=storage)
+
+class MigrationTest(DatabaseTestCase):
+    def setUp(self):
+        super(MigrationTest, self).setUp()
+        self.links = ['http://example.com/a', 'http://example.com/b']
+        blob = '\x00'.join(self.links)
+        conn = sqlite3.connect(self.location)
+        conn.execute(BASELINE_SCHEMA)
+        conn.execute('INSERT INTO snapshot (url, created, data, checksum, '
+            'regex) VALUES (?, ?, ?, ?, ?)', ('http://example.com/',
+            '2015-01-01 00:00:00', buffer(blob),
+            hashlib.sha512(blob).hexdigest(), '.+'))
+        conn.commit()
+        conn.close()
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.location)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_upgrades_baseline(self):
+        db = self.open()
+        self.assertEqual(db.schema_version, SCHEMA_VERSION)
+
+        columns = [ i[1] for i in self.query('PRAGMA table_info(snapshot)') ]
+        for column in ('encoding', 'hasher', 'digest'):
+            self.assertTrue(column in columns)
+        columns = [ i[1] for i in self.query('PRAGMA table_info(validator)') ]
+        self.assertTrue('digest' in columns)
+
+        indexes = [ i[0] for i in self.query("SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = 'snapshot'") ]
+        for index in ('snapshot_url_created',
+          'snapshot_url_regex_hasher_digest'):
+            self.assertTrue(index in indexes)
+        # superseded by the digest index
+        self.assertFalse('snapshot_url_regex_checksum' in indexes)
+
+    def test_old_rows_still_read(self):
+        self.open()
+        snapshot = Snapshot.last('http://example.com/')
+        self.assertEqual(snapshot.links, self.links)
+        self.assertEqual(snapshot.object().links, self.links)
+        # new crawls of the same links still dedup against the old row
+        found = Snapshot.exact(PageSnapshot('http://example.com/',
+            list(self.links), '.+'))
+        self.assertEqual(found.id, snapshot.id)
+
+    def test_migrating_twice(self):
+        self.open()
+        db = self.open()
+        self.assertEqual(db.schema_version, SCHEMA_VERSION)
+        self.assertEqual(Snapshot.select().count(), 1)
+
+    def test_newer_schema_refused(self):
+        conn = sqlite3.connect(self.location)
+        conn.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION + 1))
+        conn.close()
+        self.assertRaises(RuntimeError, self.open)
+
+class PackIdsTest(unittest.TestCase):
+    def roundtrip(self, ids):
+        return _unpack_ids(_pack_ids(ids))
+
+    def test_empty(self):
+        self.assertEqual(self.roundtrip([]), [])
+
+    def test_sorts(self):
+        self.assertEqual(self.roundtrip([5, 1, 3]), [1, 3, 5])
+
+    def test_varint_boundaries(self):
+        # gaps either side of each extra varint byte
+        ids = [ 1 << i for i in (0, 6, 7, 8, 13, 14, 15, 21, 28, 35, 62) ]
+        ids += [ i - 1 for i in ids ] + [ i + 1 for i in ids ]
+        ids = sorted(set(ids))
+        self.assertEqual(self.roundtrip(ids), ids)
+
+    def test_dense(self):
+        ids = range(1, 10000)
+        self.assertEqual(self.roundtrip(ids), ids)
+
+class StorageTest(DatabaseTestCase):
+    LINKS = [u'http://example.com/\u00e9t\u00e9', u'http://example.com/a',
+        'http://example.com/b']
+
+    def check(self, storage):
+        db = self.open(storage)
+        db.add_snapshot(PageSnapshot('http://example.com/',
+            list(self.LINKS), '.+'))
+        expected = sorted(i.encode('utf-8') for i in self.LINKS)
+
+        snapshot = Snapshot.last('http://example.com/')
+        self.assertEqual(snapshot.encoding, storage)
+        self.assertEqual(snapshot.links, expected)
+        self.assertEqual(snapshot.object().links, expected)
+        self.assertTrue(snapshot.matches(expected))
+
+        # a page without links reads back without any, whatever the encoding
+        db.add_snapshot(PageSnapshot('http://example.org/', [], '.+'))
+        snapshot = Snapshot.last('http://example.org/')
+        self.assertEqual(snapshot.links, [])
+        self.assertEqual(snapshot.object().links, [])
+        self.assertTrue(snapshot.matches([]))
+
+    def test_raw(self):
+        self.check(RAW)
+
+    def test_zlib(self):
+        self.check(ZLIB)
+
+    def test_interned(self):
+        self.check(INTERNED)
+
+class RetentionTest(DatabaseTestCase):
+    NOW = datetime.datetime(2015, 6, 15, 12, 0)
+
+    def retention(self):
+        return Retention(keep_all_days=30, keep_daily_days=365, now=self.NOW)
+
+    def ago(self, days, hours=0):
+        return self.NOW - datetime.timedelta(days=days, hours=hours)
+
+    def test_bucket(self):
+        retention = self.retention()
+        self.assertEqual(retention.bucket(self.NOW), None)
+        self.assertEqual(retention.bucket(self.ago(30)), None)
+        self.assertEqual(retention.bucket(self.ago(30, 1)),
+            datetime.date(2015, 5, 16))
+        self.assertEqual(retention.bucket(self.ago(365)),
+            datetime.date(2014, 6, 15))
+        # 2014-06-14 is the saturday of 2014's 24th iso week
+        self.assertEqual(retention.bucket(self.ago(365, 1)), (2014, 24))
+        # iso weeks run into the next calendar year
+        self.assertEqual(retention.bucket(datetime.datetime(2013, 1, 1)),
+            (2013, 1))
+        self.assertEqual(retention.bucket(datetime.datetime(2012, 12, 31)),
+            (2013, 1))
+
+    def test_compact(self):
+        db = self.open()
+        times = [ self.ago(i) for i in (0, 1, 40) ] + \
+            [ self.ago(40, i) for i in (1, 2) ] + \
+            [ datetime.datetime(2013, 1, i) for i in (1, 2, 3) ]
+        for i, created in enumerate(times):
+            for url in ('http://example.com/', 'http://example.org/'):
+                Snapshot.create(url=url, created=created, regex='.+',
+                    data=Snapshot.encode(PageSnapshot(url, [str(i)], '.+')))
+
+        retention = self.retention()
+        self.assertEqual(db.compact(retention, dry_run=True), 8)
+        self.assertEqual(Snapshot.select().count(), 16)
+        self.assertEqual(db.compact(retention, url='http://example.com/'), 4)
+        self.assertEqual(db.compact(retention), 4)
+
+        kept = [ i.created for i in Snapshot.select().where(
+            Snapshot.url == 'http://example.com/').order_by(Snapshot.created) ]
+        # the newest of the day, and of the week, survive
+        self.assertEqual(kept, [datetime.datetime(2013, 1, 3), self.ago(40),
+            self.ago(1), self.ago(0)])
+
+class WriterTest(DatabaseTestCase):
+    def test_bad_write_keeps_the_rest(self):
+        writer = Writer(self.open(), batch_size=10, flush_interval=10)
+        results = []
+        writer.start()
+        try:
+            for i, regex in enumerate(['.+', None, '.+']):
+                # the missing regex breaks a NOT NULL constraint
+                snapshot = PageSnapshot('http://example.com/%d' % i,
+                    ['http://example.com/a'], regex)
+                writer.add_snapshot(snapshot,
+                    callback=lambda error, i=i: results.append((i, error)))
+        finally:
+            writer.shutdown()
+
+        self.assertEqual(Snapshot.select().count(), 2)
+        results.sort()
+        self.assertEqual([ i for i, error in results if error is None ],
+            [0, 2])
+        self.assertTrue(results[1][1] is not None)
+
+    def test_flush_is_prompt(self):
+        writer = Writer(self.open(), batch_size=10, flush_interval=10)
+        writer.start()
+        try:
+            queued = datetime.datetime.now()
+            writer.add_snapshot(PageSnapshot('http://example.com/',
+                ['http://example.com/a'], '.+'))
+            crawled = datetime.datetime(2015, 1, 1)
+            writer.record_crawl('http://example.org/', '.+',
+                PageSnapshot('http://example.org/', [], '.+'),
+                created=crawled)
+            # don't wait out the batch's flush interval
+            start = time.time()
+            writer.flush()
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            writer.shutdown()
+
+        # dated when queued, not when committed
+        snapshot = Snapshot.last('http://example.com/')
+        self.assertTrue(snapshot.created - queued < datetime.timedelta(
+            seconds=1))
+        self.assertEqual(Snapshot.last('http://example.org/').created, crawled)
@@ -0,0 +1,48 @@
+import datetime
+import difflib
+import json
+import random
+import unittest
+from unfurl.diff import opcodes, unified_diff, changes, format_diff
+
+def link_pairs(count, seed=0):
+    """
+    ``count`` pairs of sorted link lists drawn from a shared pool, from
+    empty up to wholly different
+    """
+    rng = random.Random(seed)
+    for pair in xrange(count):
+        pool = [ 'http://example.com/%03d' % i for i in \
+            xrange(rng.randint(0, 40)) ]
+        old = sorted(rng.sample(pool, rng.randint(0, len(pool))))
+        new = sorted(rng.sample(pool, rng.randint(0, len(pool))))
+        yield old, new
+
+class DiffTest(unittest.TestCase):
+    def test_opcodes_match_difflib(self):
+        for old, new in link_pairs(2000):
+            expected = difflib.SequenceMatcher(None, old, new,
+                False).get_opcodes()
+            self.assertEqual(list(opcodes(old, new)), expected)
+
+    def test_unified_diff_matches_difflib(self):
+        rng = random.Random(1)
+        when = datetime.datetime(2015, 1, 1)
+        for old, new in link_pairs(2000, seed=1):
+            kwargs = dict(fromfile='a', tofile='b', n=rng.randint(0, 4),
+                fromfiledate=rng.choice(['', when]), lineterm='')
+            self.assertEqual(list(unified_diff(old, new, **kwargs)),
+                list(difflib.unified_diff(old, new, **kwargs)))
+
+    def test_changes(self):
+        self.assertEqual(changes(['a', 'b', 'd'], ['b', 'c', 'd', 'e']),
+            (['a'], ['c', 'e']))
+        self.assertEqual(changes([], []), ([], []))
+
+    def test_formats(self):
+        old, new = ['a', 'b'], ['b', 'c']
+        self.assertEqual(format_diff(old, new, 'compact'), '-a\n+c\n')
+        self.assertEqual(json.loads(format_diff(old, new, 'json',
+            url='http://example.com/')), {'url': 'http://example.com/',
+            'from': None, 'to': None, 'removed': ['a'], 'added': ['c']})
+        self.assertRaises(ValueError, format_diff, old, new, 'html')
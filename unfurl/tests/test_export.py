@@ -0,0 +1,71 @@
+import datetime
+import json
+import StringIO
+from unfurl.db import Database, Snapshot, RAW, ZLIB, INTERNED
+from unfurl.export import (
+  FORMATS, FormatUnavailable, get_format, export_snapshots, import_snapshots,
+)
+from unfurl.page import PageSnapshot
+from unfurl.tests.test_db import DatabaseTestCase
+
+LINKS = [u'http://example.com/\u00e9t\u00e9', 'http://example.com/a']
+
+class ExportTest(DatabaseTestCase):
+    def formats(self):
+        names = []
+        for name in sorted(FORMATS):
+            try:
+                get_format(name)
+            except FormatUnavailable:
+                continue
+            names.append(name)
+        return names
+
+    def export(self, format):
+        db = Database(self.location + '.%s' % format, pragmas=[],
+            storage=ZLIB)
+        for i in xrange(3):
+            Snapshot.create(url='http://example.com/%d' % i, regex='.+',
+                created=datetime.datetime(2015, 1, 1, i),
+                data=Snapshot.encode(PageSnapshot('', LINKS, '.+'), ZLIB),
+                encoding=ZLIB, hasher='sha512',
+                digest=PageSnapshot('', list(LINKS), '.+').digest)
+        fd = StringIO.StringIO()
+        self.assertEqual(export_snapshots(fd, format), 3)
+        return fd.getvalue()
+
+    def test_round_trip(self):
+        for format in self.formats():
+            data = self.export(format)
+            for storage in (RAW, ZLIB, INTERNED):
+                db = Database(self.location + '.%s.%s' % (format, storage),
+                    pragmas=[], storage=storage)
+                self.assertEqual(import_snapshots(db,
+                    StringIO.StringIO(data), format), 3)
+
+                rows = list(Snapshot.select().order_by(Snapshot.id))
+                self.assertEqual([ i.url for i in rows ],
+                    [ 'http://example.com/%d' % i for i in xrange(3) ])
+                self.assertEqual(rows[2].created,
+                    datetime.datetime(2015, 1, 1, 2))
+                for row in rows:
+                    self.assertEqual(row.encoding, storage)
+                    self.assertEqual(row.links,
+                        sorted(i.encode('utf-8') for i in LINKS))
+                    self.assertTrue(row.matches(row.links))
+
+    def test_unknown_format(self):
+        self.assertRaises(FormatUnavailable, get_format, 'xml')
+
+    def test_oldest_first(self):
+        self.open()
+        # ids out of time order, as after an import --append
+        for hour in (2, 0, 1):
+            Snapshot.create(url='http://example.com/%d' % hour, regex='.+',
+                created=datetime.datetime(2015, 1, 1, hour),
+                data=Snapshot.encode(PageSnapshot('', ['a'], '.+')))
+        fd = StringIO.StringIO()
+        export_snapshots(fd, 'jsonl')
+        self.assertEqual([ json.loads(i)['url'] for i in \
+            fd.getvalue().splitlines() ],
+            [ 'http://example.com/%d' % i for i in xrange(3) ])
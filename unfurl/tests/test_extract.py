@@ -0,0 +1,75 @@
+import unittest
+from unfurl.extract import (
+  EXTRACTORS, DEFAULT_EXTRACTOR, ExtractorUnavailable, get_extractor,
+)
+
+# awkward markup every backend has to agree on: (markup, regex)
+CORPUS = [
+  (u'', '.+'),
+  (u'<html><body>no links</body></html>', '.+'),
+  (u'<a href="b">b</a><a href="a">a</a><a href="b">again</a>', '.+'),
+  (u'<A HREF="upper">x</A><a name="anchor-only">y</a>', '.+'),
+  (u'<a href="x?a=1&amp;b=2">entity</a>', '.+'),
+  (u'<a href>empty</a><a href="">blank</a>', '.*'),
+  (u'<a href="first" href="second">dupe</a>', '.+'),
+  (u'<a href="/rel"></a><a href="http://abs/x"></a>', '^http'),
+  (u'<a href="http://h/1"><a href="http://h/2">nested', 'h/\\d'),
+  (u'<p><a href=\'single\'>q</a><a href=unquoted>u</a></p>', '.+'),
+  (u'<a href="self-closing"/><br/><a href="\u00e9t\u00e9">\u00e9</a>', '.+'),
+  (u'<!-- <a href="commented">c</a> --><a href="live">l</a>', '.+'),
+  (u'<script>var s = "<a href=\'in-script\'>";</script>'
+   u'<a href="after-script">a</a>', '.+'),
+  (u'<a\nhref="multi\nline"\n>m</a>', '.+'),
+  (u'<link href="not-an-anchor"><area href="nope"><a href="yes">', '.+'),
+  # HTMLParser stops at the unknown marked section; the others agree as
+  # long as nothing follows it
+  (u'<a href="before">b</a><![foo bar]>', '.+'),
+]
+
+def available():
+    names = []
+    for name in sorted(EXTRACTORS):
+        try:
+            get_extractor(name)
+        except ExtractorUnavailable:
+            continue
+        names.append(name)
+    return names
+
+class ExtractorTest(unittest.TestCase):
+    def test_known_links(self):
+        extract = EXTRACTORS[DEFAULT_EXTRACTOR].extract
+        self.assertEqual(extract(CORPUS[2][0], '.+'), ['a', 'b'])
+        self.assertEqual(extract(CORPUS[4][0], '.+'), ['x?a=1&b=2'])
+        self.assertEqual(extract(CORPUS[7][0], '^http'), ['http://abs/x'])
+        self.assertEqual(extract(CORPUS[14][0], '.+'), ['yes'])
+
+    def test_backends_agree(self):
+        reference = EXTRACTORS[DEFAULT_EXTRACTOR]
+        for name in available():
+            for markup, regex in CORPUS:
+                self.assertEqual(EXTRACTORS[name].extract(markup, regex),
+                    reference.extract(markup, regex),
+                    '%s disagrees on %r' % (name, markup))
+
+    def test_fed_in_pieces(self):
+        for name in available():
+            for markup, regex in CORPUS:
+                extractor = EXTRACTORS[name](regex)
+                for i in xrange(0, len(markup), 7):
+                    extractor.feed(markup[i:i + 7])
+                self.assertEqual(extractor.close(),
+                    EXTRACTORS[name].extract(markup, regex),
+                    '%s disagrees with itself on %r' % (name, markup))
+
+    def test_stream_parse_error(self):
+        markup = CORPUS[15][0] + u'<a href="after">a</a>'
+        self.assertEqual(EXTRACTORS['stream'].extract(markup, '.+'),
+            ['before'])
+        extractor = EXTRACTORS['stream']('.+')
+        for piece in (markup, u'<a href="later">l</a>'):
+            extractor.feed(piece)
+        self.assertEqual(extractor.close(), ['before'])
+
+    def test_unknown_extractor(self):
+        self.assertRaises(ExtractorUnavailable, get_extractor, 'nope')
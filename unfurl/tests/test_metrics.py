@@ -0,0 +1,41 @@
+import unittest
+from unfurl.metrics import Registry
+
+class RegistryTest(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        registry.counter('pages_total', 'Pages crawled').inc(3)
+        registry.gauge('queued', stage='a"b').set(2)
+        histogram = registry.histogram('seconds', 'Time taken',
+            buckets=(0.1, 1), stage='parse')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(registry.render(), '\n'.join([
+          '# HELP pages_total Pages crawled',
+          '# TYPE pages_total counter',
+          'pages_total 3.0',
+          '# TYPE queued gauge',
+          'queued{stage="a\\"b"} 2.0',
+          '# HELP seconds Time taken',
+          '# TYPE seconds histogram',
+          'seconds_bucket{stage="parse",le="0.1"} 1',
+          'seconds_bucket{stage="parse",le="1.0"} 2',
+          'seconds_bucket{stage="parse",le="+Inf"} 3',
+          'seconds_sum{stage="parse"} 5.55',
+          'seconds_count{stage="parse"} 3',
+        ]) + '\n')
+
+    def test_labels_split_a_family(self):
+        registry = Registry()
+        registry.counter('fetched', host='b').inc()
+        registry.counter('fetched', host='a').inc(2)
+        # the same name and labels give back the same metric
+        registry.counter('fetched', host='a').inc()
+        self.assertEqual(registry.render(), '# TYPE fetched counter\n'
+            'fetched{host="a"} 3.0\nfetched{host="b"} 1.0\n')
+
+    def test_type_clash(self):
+        registry = Registry()
+        registry.counter('pages')
+        self.assertRaises(ValueError, registry.gauge, 'pages')
@@ -0,0 +1,145 @@
+import unittest
+import requests
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+from unfurl.extract import get_extractor
+from unfurl.page import Page, get_page
+from unfurl.util import Counters
+
+class FakeResponse(object):
+    def __init__(self, chunks, content_type='text/html', error=None):
+        self.status_code = 200
+        self.headers = {'content-type': content_type}
+        self.encoding = requests.utils.get_encoding_from_headers(self.headers)
+        self.chunks = chunks
+        self.error = error
+
+    def iter_content(self, size):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error:
+            raise self.error
+
+    def close(self):
+        pass
+
+class FakeSession(object):
+    def __init__(self, response):
+        self.response = response
+
+    def get(self, url, **kwargs):
+        return self.response
+
+class PageLoadTest(unittest.TestCase):
+    def load(self, response, **kwargs):
+        page = Page('http://example.com/')
+        page.load(session=FakeSession(response), **kwargs)
+        return page
+
+    def test_body_timeout_fails_page(self):
+        counters = Counters()
+        timeout = ReadTimeoutError(None, 'http://example.com/', 'timed out')
+        page = self.load(FakeResponse(['<a href="x">'],
+            error=requests.exceptions.ConnectionError(timeout)),
+            counters=counters)
+        self.assertTrue(page.failed)
+        self.assertEqual(page.digest, None)
+        self.assertEqual(counters.reset().get('timeouts'), 1)
+
+    def test_broken_body_fails_page(self):
+        for error in (requests.exceptions.ChunkedEncodingError('cut off'),
+          requests.exceptions.ContentDecodingError('bad gzip')):
+            page = self.load(FakeResponse(['<a href="x">'], error=error),
+                extractor=get_extractor('stream')('.+'))
+            self.assertTrue(page.failed)
+            self.assertFalse(page.parsed)
+
+    def test_unknown_charset(self):
+        body = ['<a href="caf\xc3\xa9">', '</a>']
+        content_type = 'text/html; charset=x-unknown'
+        page = self.load(FakeResponse(body, content_type))
+        self.assertEqual(page.links, [u'caf\u00e9'])
+        page = self.load(FakeResponse(body, content_type),
+            extractor=get_extractor('stream')('.+'))
+        self.assertEqual(page.links, [u'caf\u00e9'])
+
+class ScriptedSession(object):
+    """
+    Answers each request with the next of ``outcomes``, raising it if it's
+    an exception, and keeps the headers each request was sent
+    """
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = 0
+        self.sent = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests += 1
+        self.sent.append(headers)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+class GetPageTest(unittest.TestCase):
+    def fetch(self, outcomes, retries=2):
+        counters = Counters()
+        session = ScriptedSession(outcomes)
+        response = get_page('http://example.com/', session=session,
+            retries=retries, backoff=0, counters=counters)
+        return response, session.requests, counters.reset()
+
+    def error_response(self, status):
+        response = FakeResponse([])
+        response.status_code = status
+        return response
+
+    def test_retries_until_success(self):
+        ok = FakeResponse([])
+        response, requests_made, counts = self.fetch([
+          requests.exceptions.ConnectionError('refused'),
+          requests.exceptions.ReadTimeout('slow'),
+          ok,
+        ])
+        self.assertTrue(response is ok)
+        self.assertEqual(requests_made, 3)
+        self.assertEqual(counts, {'retries': 2, 'timeouts': 1})
+
+    def test_retryable_status(self):
+        response, requests_made, counts = self.fetch([
+          self.error_response(503), self.error_response(200)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(counts, {'retries': 1})
+
+        # out of retries, the last error response is handed back
+        response, requests_made, counts = self.fetch([
+          self.error_response(503), self.error_response(502)], retries=1)
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(requests_made, 2)
+
+    def test_not_retryable_status(self):
+        response, requests_made, counts = self.fetch([
+          self.error_response(404)])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(counts, {})
+
+    def test_gives_up(self):
+        response, requests_made, counts = self.fetch(
+            [ requests.exceptions.ConnectionError('refused') ] * 3)
+        self.assertEqual(response, None)
+        self.assertEqual(requests_made, 3)
+
+    def test_fails_at_once(self):
+        for error in (requests.exceptions.MissingSchema('no scheme'),
+          requests.exceptions.InvalidSchema('ftp'),
+          requests.exceptions.InvalidURL('bad url'),
+          requests.exceptions.TooManyRedirects('loop')):
+            response, requests_made, counts = self.fetch([error, None, None])
+            self.assertEqual(response, None)
+            self.assertEqual(requests_made, 1)
+            self.assertEqual(counts, {})
+
+    def test_failed_page(self):
+        page = Page('ftp://example.com/x')
+        page.load(session=ScriptedSession([
+            requests.exceptions.InvalidSchema('ftp')]))
+        self.assertTrue(page.failed)
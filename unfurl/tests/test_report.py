@@ -0,0 +1,39 @@
+import datetime
+import json
+from unfurl.db import Snapshot
+from unfurl.page import PageSnapshot
+from unfurl.report import report
+from unfurl.tests.test_db import DatabaseTestCase
+
+URL = 'http://example.com/'
+
+class ReportTest(DatabaseTestCase):
+    def setUp(self):
+        super(ReportTest, self).setUp()
+        self.open()
+        self.times = [ datetime.datetime(2015, 1, i) for i in (1, 2) ]
+        for created, links in zip(self.times, [['a', 'b'], ['b', 'c']]):
+            Snapshot.create(url=URL, regex='.+', created=created,
+                data=Snapshot.encode(PageSnapshot(URL, links, '.+')))
+
+    def test_changes(self):
+        self.assertEqual(list(report(format='compact')), [
+          '%s\t%s\n+a\n+b\n' % (URL, self.times[0]),
+          '%s\t%s\n-a\n+c\n' % (URL, self.times[1]),
+        ])
+
+    def test_since(self):
+        # the page's earlier snapshot is still what the change is against
+        diffs = [ json.loads(i) for i in report(format='json',
+            since=self.times[1]) ]
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(diffs[0]['url'], URL)
+        self.assertEqual(diffs[0]['removed'], ['a'])
+        self.assertEqual(diffs[0]['added'], ['c'])
+
+    def test_until(self):
+        self.assertEqual(len(list(report(until=self.times[1]))), 1)
+
+    def test_processes(self):
+        self.assertEqual(list(report(format='compact', processes=1)),
+            list(report(format='compact')))
@@ -0,0 +1,106 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+URL = 'http://example.com/'
+
+# what diff and dump have no use for
+HEAVY = ('requests', 'bs4', 'lxml', 'gevent', 'multiprocessing',
+    'BaseHTTPServer', 'xxhash', 'pyblake2', 'cProfile')
+
+# runs a command, then reports the top-level modules it imported
+RUNNER = '''
+import atexit, sys
+atexit.register(lambda: sys.stderr.write('MODULES %%s\\n' %% ' '.join(
+    sorted(set(i.split('.')[0] for i in sys.modules)))))
+sys.argv = %r
+from unfurl.cli import main
+main()
+'''
+
+# what the quick commands can't do without; startup is measured against
+# importing these, so the budget scales with the machine running the test
+REFERENCE = 'import peewee, sqlite3'
+
+# how many times the reference import's cost a command may add to
+# interpreter startup. They take about 1.5 times; importing the crawler's
+# dependencies took them to 4.
+BUDGET = 2.5
+
+# runs of each command; the fastest is taken, since noise only adds time
+REPEAT = 5
+
+class StartupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from unfurl.db import Database
+        from unfurl.page import PageSnapshot
+
+        cls.tmpdir = tempfile.mkdtemp(prefix='unfurl-test-')
+        location = os.path.join(cls.tmpdir, 'db.sqlite3')
+        db = Database(location, pragmas=[])
+        for version in xrange(2):
+            links = [ '%spage/%d/%d' % (URL, i, version) for i in xrange(100) ]
+            db.add_snapshot(PageSnapshot(URL, links, '.+'))
+        cls.env = dict(os.environ, UNFURL_DATABASE=location,
+            UNFURL_CONFIG=os.path.join(cls.tmpdir, 'missing.cfg'),
+            PYTHONPATH=ROOT)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def run_code(self, code):
+        """
+        Run ``code`` in a new interpreter, returning the seconds it took and
+        the modules it imported (if it reports them)
+        """
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+            env=self.env, stdout=open(os.devnull, 'w'),
+            stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+        elapsed = time.time() - start
+        self.assertEqual(process.returncode, 0, stderr)
+
+        modules = []
+        for line in stderr.splitlines():
+            if line.startswith('MODULES '):
+                modules = line.split()[1:]
+        return elapsed, modules
+
+    def command(self, name):
+        return RUNNER % ['unfurl', name, URL]
+
+    def test_no_heavy_imports(self):
+        for name in ('diff', 'dump'):
+            modules = self.run_code(self.command(name))[1]
+            self.assertEqual([ i for i in HEAVY if i in modules ], [],
+                '%s imported crawl-only modules' % name)
+
+    def test_startup_budget(self):
+        codes = {
+          'bare': 'pass',
+          'reference': REFERENCE,
+          'diff': self.command('diff'),
+          'dump': self.command('dump'),
+        }
+        fastest = dict((name, None) for name in codes)
+        # interleaved, so a slow patch of the machine hits every one
+        for i in xrange(REPEAT):
+            for name, code in codes.items():
+                elapsed = self.run_code(code)[0]
+                fastest[name] = min(fastest[name] or elapsed, elapsed)
+
+        bare = fastest['bare']
+        budget = (fastest['reference'] - bare) * BUDGET
+        for name in ('diff', 'dump'):
+            taken = fastest[name] - bare
+            self.assertTrue(taken <= budget, '%s took %.0f ms to start, over '
+                'its %.0f ms budget' % (name, taken * 1000, budget * 1000))
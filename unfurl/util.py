@@ -1,15 +1,150 @@
+import datetime
+import importlib
 import time
 import logging
+import signal
+import threading
 
 LOG = logging.getLogger(__name__)
 
-def timeit(description='action'):
+def timeit(description='action', histogram=None):
+    """
+    Log how long each call of the decorated function takes and, if given
+    a ``unfurl.metrics.Histogram``, record it there
+    """
     def timeit_inner(func):
         def wrapped(*args, **kwargs):
             now = time.time()
-            result = func(*args, **kwargs)
-            elapsed = time.time() - now
-            LOG.debug('%s took %.3f seconds' % (description, elapsed))
-            return result
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - now
+                if histogram is not None:
+                    histogram.observe(elapsed)
+                LOG.debug('%s took %.3f seconds' % (description, elapsed))
         return wrapped
     return timeit_inner
+
+class LazyModule(object):
+    """
+    Stands in for the module ``name``, importing it the first time one of
+    its attributes is used. Heavy dependencies that only some commands need
+    are held this way so the others don't pay to import them.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %s>' % self._name
+
+def importable(module):
+    """
+    Whether the ``LazyModule`` ``module`` can be imported
+    """
+    try:
+        module._load()
+    except ImportError:
+        return False
+    return True
+
+def chunked(items, size):
+    """
+    Yield successive lists of at most ``size`` items from ``items``
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# units of relative times, in seconds
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
+def parse_time(value, now=None):
+    """
+    Parse ``value``, either a date and time (``2014-01-31``,
+    ``2014-01-31 12:00``) or a time relative to ``now`` (``90m``, ``2d``,
+    ``1w`` ago), into a ``datetime``
+    """
+    value = value.strip()
+    unit = TIME_UNITS.get(value[-1:])
+    if unit and value[:-1].isdigit():
+        now = now or datetime.datetime.now()
+        return now - datetime.timedelta(seconds=int(value[:-1]) * unit)
+
+    for format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('could not understand time "%s"' % value)
+
+def patch_for_gevent():
+    """
+    Have gevent monkey-patch the standard library (threads excepted) for
+    the async engine, returning whether it's installed. gevent only
+    supports patching before ``ssl`` is imported, so entry points do this
+    first, before anything imports ``requests``.
+    """
+    try:
+        import gevent.monkey
+    except ImportError:
+        return False
+    gevent.monkey.patch_all(thread=False)
+    return True
+
+def ignore_interrupts():
+    """
+    Worker process initializer: leave ^C to the parent process, which
+    tears the pool down
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class Counters(object):
+    """
+    Thread-safe named counters. With a ``registry``, each one also counts
+    towards the ``metric`` counter there, labelled ``event=<name>``; those
+    are never reset.
+    """
+    def __init__(self, registry=None, metric='unfurl_events_total'):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._registry = registry
+        self._metric = metric
+        self._metrics = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+        if self._registry is not None:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = self._registry.counter(
+                    self._metric, 'Crawl events, by kind', event=name)
+            metric.inc(amount)
+
+    def get(self, name):
+        return self._counts.get(name, 0)
+
+    def reset(self):
+        """
+        Zero every counter, returning their values beforehand
+        """
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        return counts